@@ -1,32 +1,164 @@
 import os
+from collections import MutableMapping
+from itertools import groupby
+from operator import itemgetter
 
+from been import stats
+from been.engine import Dispatcher, UpdateEngine
 from been.stores import create_store
-from been.sources import create_source
+from been.sources import adopt, create_source, process_batches, worker_config
+from been.util import batches
+
+
+class SourceMap(MutableMapping):
+    """Maps source ids to sources. Stored sources are only created from
+    their configs when first accessed, so that commands which touch few
+    sources do not pay for building them all."""
+    def __init__(self, configs=()):
+        self.configs = dict(configs)
+        self.created = {}
+
+    def __getitem__(self, source_id):
+        source = self.created.get(source_id)
+        if source is None:
+            source = self.created[source_id] = create_source(self.configs[source_id])
+        return source
+
+    def __setitem__(self, source_id, source):
+        self.configs[source_id] = source.config
+        self.created[source_id] = source
+
+    def __delitem__(self, source_id):
+        del self.configs[source_id]
+        self.created.pop(source_id, None)
+
+    def __contains__(self, source_id):
+        return source_id in self.configs
+
+    def __iter__(self):
+        return iter(self.configs)
+
+    def __len__(self):
+        return len(self.configs)
 
 
 class Been(object):
-    def __init__(self):
-        self.sources = {}
+    # Default per-source fetch timeout (seconds) and per-host fetch limit for
+    # parallel updates. Sources can override the timeout with a "timeout"
+    # config value.
+    fetch_timeout = 120
+    host_limit = 2
+
+    def __init__(self, store=None):
+        self.errors = {}
+        # The stats.SourceStats of each source in the last update.
+        self.stats = {}
+        # The ids of sources being fetched, including fetches that were
+        # given up on but have not finished.
+        self.fetching = set()
 
         engine = os.environ.get('BEEN_STORE', 'couch')
-        self.store = create_store(engine)
+        self.store = store or create_store(engine)
 
-        for source_id, source_data in self.store.get_sources().iteritems():
-            self.sources[source_id] = create_source(source_data)
+        self.sources = SourceMap(self.store.get_sources())
 
     def add(self, source):
         self.sources[source.source_id] = source
         self.store.store_source(source)
 
-    def update(self, sources=None):
-        sources = sources or self.sources.itervalues()
+    def update(self, sources=None, jobs=None, full=False):
+        sources = list(sources or self.sources.itervalues())
+        if jobs > 1:
+            return self.update_parallel(sources, jobs, full)
+
+        changed = {}
+        self.stats = stats.start(sources)
+        try:
+            for source in sources:
+                with stats.collect(self.stats[source.source_id]):
+                    changed[source.source_id] = self.store.store_update(source, source.fetch(full))
+        finally:
+            # Sources after one that failed were not updated.
+            stats.save(self.store, [self.stats[source.source_id] for source in sources[:len(changed) + 1]])
+        return changed
+
+    def update_parallel(self, sources, jobs, full=False):
+        """Fetches sources on up to `jobs` threads at once, storing each result
+        as it arrives. At most `host_limit` fetches run against one host at a
+        time. Sources that fail or exceed their timeout are recorded in
+        self.errors and left out of the returned change counts.
+
+        Fetches run on copies of their sources (see engine.Dispatcher), whose
+        fetch state is only taken on when their events are stored. Sources
+        whose previous fetch was given up on but is still running are
+        skipped until it finishes."""
+        sources = list(sources)
+        self.stats = stats.start(sources)
+
+        def fetch(worker):
+            # Consume lazy sources here rather than in the storing thread.
+            with stats.collect(self.stats[worker.source_id]):
+                return list(worker.fetch(full))
+
         changed = {}
-        for source in sources:
-            changed[source.source_id] = self.store.store_update(source, source.fetch())
+        self.errors = {}
+        dispatcher = Dispatcher({None: jobs}, self.host_limit, self.fetch_timeout, self.fetching)
+        for source, worker, events, error in dispatcher.run(sources, fetch):
+            if error:
+                self.errors[source.source_id] = error
+            else:
+                adopt(source, worker)
+                with stats.collect(self.stats[source.source_id]):
+                    changed[source.source_id] = self.store.store_update(source, events)
+
+        for source_id, error in self.errors.iteritems():
+            self.stats[source_id].fail(error)
+        stats.save(self.store, self.stats.values())
+        return changed
+
+    def update_async(self, sources=None, concurrency=32, full=False, parse_processes=None):
+        """Updates sources with an UpdateEngine: all feeds are requested
+        concurrently, up to `concurrency` at a time, with the same per-host
+        limit and timeouts as update_parallel."""
+        engine = UpdateEngine(self.store, concurrency, parse_processes, host_limit=self.host_limit,
+                              timeout=self.fetch_timeout, busy=self.fetching)
+        changed = engine.run(sources or self.sources.itervalues(), full)
+        self.errors = engine.errors
+        self.stats = engine.stats
+        stats.save(self.store, self.stats.values())
         return changed
 
-    def reprocess(self):
-        def reprocess_iter():
-            for event in self.store.events():
-                yield self.sources[event['source']].process_event(event)
-        self.store.store_events(list(reprocess_iter()))
+    def reprocess(self, processes=None, source=None, after=None, before=None, restart=False):
+        """Reprocesses every stored event (optionally only those of one source
+        or within a time range), a page at a time. Each page is processed on
+        `processes` worker processes if given, written back in batches, and
+        then checkpointed, so an interrupted run resumes where it stopped
+        unless `restart` is set."""
+        filters = [source, after, before]
+        checkpoint = self.store.get_state('reprocess')
+        cursor = None
+        if checkpoint and checkpoint['filters'] == filters and not restart:
+            cursor = checkpoint['cursor']
+
+        for page, cursor in self.store.event_pages(source, after, before, cursor=cursor):
+            # Events of sources that were since removed, and events whose raw
+            # data was stripped by compaction, are left alone.
+            page = [event for event in page if event['source'] in self.sources and not event.get('stripped')]
+            runs = [(self.sources[source_id], list(events))
+                    for source_id, events in groupby(page, itemgetter('source'))]
+
+            if processes > 1:
+                work = ((worker_config(source), batch)
+                        for source, events in runs
+                        for batch in batches(events, 16))
+                processed = process_batches(work, processes)
+            else:
+                processed = (event
+                             for source, events in runs
+                             for event in source.process_events(events))
+
+            self.store.store_events(event for event in processed if event)
+            self.store.store_state('reprocess', {'filters': filters, 'cursor': cursor})
+
+        self.store.store_state('reprocess', None)
+
@@ -0,0 +1,225 @@
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from been import Been, codec, http
+from been.sources import FeedSource
+from been.stores import SqliteStore, Store
+
+
+benchmarks = {}
+def benchmark(f):
+    benchmarks[f.func_name] = f
+    return f
+
+
+FEED_FORMAT = '<?xml version="1.0"?><rss version="2.0"><channel><title>{path}</title>{items}</channel></rss>'
+ITEM_FORMAT = ('<item><title>Entry {n} of {path}</title><link>http://example.com{path}/{n}</link>'
+               '<pubDate>{date}</pubDate><description>{text}</description></item>')
+
+
+class MockFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = FEED_FORMAT.format(path=self.path, items=''.join(
+            ITEM_FORMAT.format(
+                path=self.path,
+                n=n,
+                date=time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(1e9 + n * 3600)),
+                text='lorem ipsum ' * 20,
+            ) for n in xrange(self.server.entries)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves generated RSS feeds of `entries` items at any path on a local
+    port, after an injected delay of `latency` seconds."""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, latency=0, entries=20):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockFeedHandler)
+        self.latency = latency
+        self.entries = entries
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+
+class BenchFeedSource(FeedSource):
+    kind = 'bench-feed'
+
+    @property
+    def source_id(self):
+        return self.kind+':'+self.config['url']
+
+
+class NullStore(Store):
+    """Discards everything written to it, so that benchmarks measure fetching
+    and processing alone."""
+    def get_sources(self):
+        return {}
+
+    def store_source(self, source):
+        pass
+
+    def get_state(self, key, default=None):
+        return default
+
+    def store_state(self, key, value):
+        pass
+
+    def store_batch(self, events):
+        return events
+
+    def remove_events(self, ids):
+        pass
+
+    def write_batch(self, batch):
+        return batch
+
+    def update_timeline(self, source_id, config, changed, removed=()):
+        pass
+
+    def rebuild_timeline(self):
+        pass
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    print '{0:>12}: {1:.2f}s'.format(label, time.time() - start)
+    return result
+
+
+@benchmark
+def update(app, feeds=100, latency=0.1, concurrency=32):
+    """update (feeds) (latency) (concurrency): Times serial, threaded (--jobs) and --async updates of (feeds) mock feeds served with (latency) seconds of delay."""
+    server = MockFeedServer(latency=float(latency))
+    feeds, concurrency = int(feeds), int(concurrency)
+
+    def runner():
+        app = Been(store=NullStore())
+        # Every mock feed is on the same host, which the per-host limit
+        # would otherwise make the bottleneck.
+        app.host_limit = max(app.host_limit, concurrency, 8)
+        for n in xrange(feeds):
+            app.add(BenchFeedSource({'url': '{0}/feed/{1}'.format(server.url, n)}))
+        return app
+
+    print 'Updating {0} feeds, {1}s latency:'.format(feeds, latency)
+    timed('serial', runner().update)
+    timed('jobs=8', runner().update, jobs=8)
+    timed('async', runner().update_async, concurrency=concurrency)
+    http.client.close()
+    server.shutdown()
+
+
+@benchmark
+def codecs(app, count=1000):
+    """codecs (count): Compares the size and speed of stored value codecs on the (count) newest stored events."""
+    events = list(app.store.events(count=int(count)))
+    if not events:
+        print 'No stored events to sample.'
+        return
+
+    specs = ['pickle', 'json', 'json+zlib']
+    if codec.msgpack:
+        specs += ['msgpack', 'msgpack+zlib']
+    if codec.zstandard:
+        specs += ['json+zstd'] + (['msgpack+zstd'] if codec.msgpack else [])
+
+    print 'Sampling {0} events:'.format(len(events))
+    print '{0:>14} {1:>12} {2:>14} {3:>14}'.format('codec', 'bytes/event', 'encode/s', 'decode/s')
+    for spec in specs:
+        encoder = codec.Codec.from_spec(spec)
+        start = time.time()
+        encoded = [encoder.encode(event) for event in events]
+        encode_time = time.time() - start
+        start = time.time()
+        for data in encoded:
+            codec.decode(data)
+        decode_time = time.time() - start
+        print '{0:>14} {1:>12.0f} {2:>14.0f} {3:>14.0f}'.format(
+            spec,
+            sum(len(data) for data in encoded) / float(len(events)),
+            len(events) / max(encode_time, 1e-9),
+            len(events) / max(decode_time, 1e-9),
+        )
+
+
+def bench_events(count, sources=10):
+    return [{
+        'summary': 'Event {0}'.format(n),
+        'content': 'lorem ipsum ' * 20,
+        'timestamp': 1e9 + n * 600,
+        'kind': 'bench',
+        'source': 'bench:{0}'.format(n % sources),
+    } for n in xrange(count)]
+
+
+@benchmark
+def store(app, count=10000):
+    """store (count): Times writing, rewriting and reading (count) events with a fresh SQLite store, the reference backend."""
+    count = int(count)
+    path = tempfile.mkdtemp()
+    try:
+        store = SqliteStore(os.path.join(path, 'bench.sqlite'))
+        print 'Storing {0} events:'.format(count)
+        timed('insert', store.store_events, bench_events(count))
+        timed('unchanged', store.store_events, bench_events(count))
+
+        def read_pages():
+            return sum(len(page) for page, cursor in store.event_pages(page_size=100))
+        timed('read pages', read_pages)
+        timed('histogram', store.histogram, 'day')
+        timed('timeline', store.rebuild_timeline)
+    finally:
+        shutil.rmtree(path)
+
+
+# Run in a fresh interpreter, so that nothing is imported already.
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+import been.cli
+imported = time.time()
+app = been.Been()
+print json.dumps({
+    'import': imported - start,
+    'init': time.time() - imported,
+    'modules': [name for name in %r if name in sys.modules],
+})
+"""
+OPTIONAL_MODULES = ('couchdb', 'redis', 'feedparser', 'markdown', 'msgpack', 'zstandard')
+
+
+@benchmark
+def startup(app, runs=5):
+    """startup (runs): Times importing been and creating the app with the configured store (BEEN_STORE) in fresh interpreters, best of (runs), and lists the optional modules loaded by then."""
+    results = [json.loads(subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT % (OPTIONAL_MODULES,)]))
+               for run in xrange(int(runs))]
+    print 'Starting {0} times:'.format(len(results))
+    for phase in ('import', 'init'):
+        print '{0:>12}: {1:.3f}s'.format(phase, min(result[phase] for result in results))
+    print '{0:>12}: {1}'.format('loaded', ', '.join(results[-1]['modules']) or 'none')
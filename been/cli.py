@@ -2,6 +2,7 @@
 import sys
 import json
 import time
+import calendar
 
 from been import Been
 from been.stores import create_store, store_map
@@ -38,19 +39,80 @@ def disambiguate(key, dict_, desc='key'):
     return item
 
 
+def parse_options(args, takes_value=()):
+    """Splits --options out of a command's arguments.
+
+    Options named in `takes_value` consume a value ("--jobs 4" or "--jobs=4"),
+    which is decoded as JSON if possible. Other options are flags set to True.
+    Returns the remaining positional arguments and a dict of options."""
+    args = list(args)
+    positional = []
+    options = {}
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith('--'):
+            positional.append(arg)
+            continue
+
+        key, sep, value = arg[2:].partition('=')
+        if key in takes_value:
+            if not sep:
+                if not args:
+                    print 'Option --{key} requires a value.'.format(key=key)
+                    sys.exit(1)
+                value = args.pop(0)
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+            options[key] = value
+        else:
+            options[key] = True
+    return positional, options
+
+
+def parse_time(value):
+    """Parses a Unix timestamp or a YYYY-MM-DD date (UTC) given as an option."""
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    try:
+        return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        print "Invalid time '{value}': expected a Unix timestamp or YYYY-MM-DD.".format(value=value)
+        sys.exit(1)
+
+
 @command()
-def update(app, source_id=None):
-    """update (source_id): Fetches events from all sources. If (source_id) is specified, updates a single source."""
-    if source_id:
-        source = disambiguate(source_id, app.sources, 'source')
-        changed = app.update([source])
+def update(app, *args):
+    """update (source_id) (--jobs N | --async (--concurrency N)) (--full): Fetches events from all sources. If (source_id) is specified, updates a single source. With --jobs, fetches N sources in parallel. With --async, requests all feeds concurrently (up to --concurrency at a time, default 32). With --full, refetches events that were already stored."""
+    args, options = parse_options(args, takes_value=('jobs', 'concurrency', 'parse-processes'))
+    sources = [disambiguate(args[0], app.sources, 'source')] if args else None
+    full = options.get('full', False)
+    if options.get('async'):
+        changed = app.update_async(sources, options.get('concurrency', 32), full,
+                                   parse_processes=options.get('parse-processes'))
     else:
-        changed = app.update()
+        changed = app.update(sources, jobs=options.get('jobs'), full=full)
+    print_changes(changed, app.errors)
 
+
+def print_changes(changed, errors):
     print '{ts} -- +{total} events [{changes}]'.format(
             ts = time.ctime(),
             total = sum(changed.itervalues()),
             changes = ', '.join('{0}(+{1})'.format(_id, count) for _id, count in changed.iteritems()))
+    for source_id, error in errors.iteritems():
+        print '  ! {0}: {1}'.format(source_id, error)
+
+
+@command()
+def daemon(app, *args):
+    """daemon (--jobs N): Keeps running, polling each source on an adaptive schedule (N sources at a time, default 4)."""
+    from been.daemon import Scheduler
+    args, options = parse_options(args, takes_value=('jobs',))
+    for changed, errors in Scheduler(app, options.get('jobs', 4)).run():
+        print_changes(changed, errors)
+        sys.stdout.flush()
 
 
 @command()
@@ -77,13 +139,78 @@ def add(app, kind=None, *args):
 
 
 @command()
-def log(app):
-    """log: Displays summaries for the 100 newest events."""
-    for event in app.store.events():
+def log(app, *args):
+    """log (--count N) (--cursor CURSOR) (--source ID) (--after TIME) (--before TIME): Displays summaries for the newest events (100 by default), and the cursor of the next page. --source, --after and --before (Unix time or YYYY-MM-DD) limit which events are shown."""
+    args, options = parse_options(args, takes_value=('count', 'cursor', 'source', 'after', 'before'))
+    source = options.get('source')
+    if source:
+        source = disambiguate(source, app.sources, 'source').source_id
+    events, cursor = app.store.events_page(
+        options.get('count', 100),
+        options.get('cursor'),
+        source=source,
+        after=parse_time(options.get('after')),
+        before=parse_time(options.get('before')),
+    )
+    for event in events:
         print u'{timestamp} -- {summary}'.format(
             timestamp=time.ctime(event['timestamp']),
             summary=event['summary'],
         )
+    if cursor:
+        print 'next: --cursor ' + cursor
+
+
+@command()
+def timeline(app, *args):
+    """timeline (--count N) (--cursor CURSOR) (--rebuild): Displays the newest entries of the collapsed timeline, and the cursor of the next page. With --rebuild, first regroups the timeline from the stored events (needed after changing a source's "collapse" setting)."""
+    args, options = parse_options(args, takes_value=('count', 'cursor'))
+    if options.get('rebuild'):
+        app.store.rebuild_timeline()
+
+    items, cursor = app.store.timeline(options.get('count', 20), options.get('cursor'))
+    for item in items:
+        if 'children' in item:
+            print u'{timestamp} -- {source}: {count} events'.format(
+                timestamp=time.ctime(item['timestamp']),
+                source=item['source'],
+                count=len(item['children']),
+            )
+        else:
+            print u'{timestamp} -- {summary}'.format(
+                timestamp=time.ctime(item['timestamp']),
+                summary=item['summary'],
+            )
+    if cursor:
+        print 'next: --cursor ' + cursor
+
+
+@command()
+def search(app, *args):
+    """search <words> (--source ID) (--kind KIND) (--after TIME) (--before TIME) (--count N) (--rebuild): Finds the events whose summary, title, content or metadata contain all of <words>, best match first. With --rebuild, first reindexes all stored events."""
+    args, options = parse_options(args, takes_value=('source', 'kind', 'after', 'before', 'count'))
+    if options.get('rebuild'):
+        app.store.rebuild_search()
+    if not args:
+        return
+
+    source = options.get('source')
+    if source:
+        source = disambiguate(source, app.sources, 'source').source_id
+    results = app.store.search(
+        ' '.join(args),
+        count=options.get('count', 20),
+        source=source,
+        kind=options.get('kind'),
+        after=parse_time(options.get('after')),
+        before=parse_time(options.get('before')),
+    )
+    for score, event in results:
+        print u'{score:6.2f} {timestamp} -- {summary}'.format(
+            score=score,
+            timestamp=time.ctime(event['timestamp']),
+            summary=event['summary'],
+        )
 
 
 @command(name='list')
@@ -94,7 +221,7 @@ def list_(app, format=None):
         print '{name}'.format(name = source_id)
         if not format == 'short':
             print '  {0} events'.format(counts.get(source_id, 0))
-            for field in ['username', 'url', 'collapse', 'syndicate']:
+            for field in ['username', 'url', 'collapse', 'retention', 'syndicate', 'http']:
                 if field in source.config:
                     print '  * {0}: {1}'.format(field, source.config[field])
 
@@ -106,9 +233,80 @@ def empty(app):
 
 
 @command()
-def reprocess(app):
-    """reprocess: Reprocesses events using their stored data."""
-    app.reprocess()
+def rollup(app, *args):
+    """rollup (day|week|month) (--source ID) (--kind KIND) (--rebuild): Displays a histogram of events per day, week or month, optionally for one source or kind. With --rebuild, first recomputes the rollup counters from the stored events."""
+    args, options = parse_options(args, takes_value=('source', 'kind'))
+    period = args[0] if args else 'day'
+    if period not in ('day', 'week', 'month'):
+        print "Invalid period '{period}': expected day, week or month.".format(period=period)
+        sys.exit(1)
+    source = options.get('source')
+    if source:
+        source = disambiguate(source, app.sources, 'source').source_id
+
+    if options.get('rebuild'):
+        print 'Rebuilt rollups: {0} counters were wrong.'.format(app.store.rebuild_rollups())
+
+    histogram = app.store.histogram(period, source=source, kind=options.get('kind'))
+    scale = 50.0 / max([count for bucket, count in histogram] or [1])
+    for bucket, count in histogram:
+        print '{0:>10} {1:>6} {2}'.format(bucket, count, '#' * int(round(count * scale)))
+
+
+@command(name='stats')
+def stats_(app, *args):
+    """stats (source_id) (--prometheus): Displays how long recent updates of each source spent fetching, parsing, processing, serializing and storing, with the bytes fetched and stored, events, "not modified" responses and errors. With --prometheus, prints the metrics of the last updates in the Prometheus text format. Set BEEN_PROFILE to a directory to also dump a cProfile of each source's last update there."""
+    from been import stats
+    args, options = parse_options(args)
+    source_ids = app.sources.keys()
+    if args:
+        source_ids = [disambiguate(args[0], app.sources, 'source').source_id]
+    history = stats.load(app.store, source_ids)
+    if options.get('prometheus'):
+        sys.stdout.write(stats.prometheus(history))
+        return
+
+    for source_id, runs in sorted(history.iteritems()):
+        if not runs:
+            continue
+        summary = stats.summarize(runs)
+        last, totals = summary['last'], summary['totals']
+        print source_id
+        print '  {0} updates ({1} failed), last at {2} took {3:.2f}s'.format(
+            summary['updates'], summary['errors'], time.ctime(last['time']), last['elapsed'])
+        print '  mean: {0}, total {1:.2f}s'.format(', '.join(
+            '{0} {1:.2f}s'.format(phase, summary['mean_phases'].get(phase, 0))
+            for phase in stats.PHASES + ('other',)), summary['mean_elapsed'])
+        print '  fetched {0:.1f} KB, stored {1:.1f} KB, {2} events ({3} changed)'.format(
+            totals.get('fetched_bytes', 0) / 1024.0, totals.get('stored_bytes', 0) / 1024.0,
+            totals.get('events', 0), totals.get('changed', 0))
+        if summary['not_modified_ratio'] is not None:
+            print '  {0:.0%} of {1} requests not modified'.format(summary['not_modified_ratio'], totals['requests'])
+        if last['error']:
+            print '  last error: {0}'.format(last['error'])
+
+
+@command()
+def compact(app):
+    """compact: Applies each source's "retention" setting, a JSON object such as {"max_age": 365, "max_count": 1000, "strip_after": 30}. Events older than max_age days or beyond the newest max_count are removed, and the fetched data of events older than strip_after days is dropped (they can no longer be reprocessed). Set it with: configure <source> retention <json>"""
+    removed, stripped, reclaimed = app.store.compact()
+    print 'Removed {0} events and stripped {1}, reclaiming {2:.1f} KB.'.format(removed, stripped, reclaimed / 1024.0)
+
+
+@command()
+def reprocess(app, *args):
+    """reprocess (--processes N) (--source ID) (--after TIME) (--before TIME) (--restart): Reprocesses all stored events using their stored data, resuming an interrupted run unless --restart is given. With --processes, processes events on N worker processes. --source, --after and --before (Unix time or YYYY-MM-DD) limit which events are redone."""
+    args, options = parse_options(args, takes_value=('processes', 'source', 'after', 'before'))
+    source = options.get('source')
+    if source:
+        source = disambiguate(source, app.sources, 'source').source_id
+    app.reprocess(
+        processes=options.get('processes'),
+        source=source,
+        after=parse_time(options.get('after')),
+        before=parse_time(options.get('before')),
+        restart=options.get('restart', False),
+    )
 
 
 @command()
@@ -128,8 +326,10 @@ def configure(app, source_id, key, *args):
 
 
 @command()
-def migrate(app, from_store, to_store):
-    """migrate <from> <to>: copies your source/event storage from one backend to another."""
+def migrate(app, from_store=None, to_store=None, *args):
+    """migrate <from> <to> (--restart) (--page-size N): copies your source/event storage from one backend to another, a page at a time. An interrupted migration resumes where it stopped unless --restart is given."""
+    from been import transfer
+    args, options = parse_options(args, takes_value=('page-size',))
 
     bad_store = None
 
@@ -145,20 +345,64 @@ def migrate(app, from_store, to_store):
             print "  " + store
         sys.exit(1)
 
-    from_store = create_store(from_store)
-    to_store = create_store(to_store)
+    def progress(copied):
+        sys.stdout.write('\rCopied {0} events'.format(copied))
+        sys.stdout.flush()
+
+    mismatched = transfer.migrate(create_store(from_store), create_store(to_store),
+                                  origin=from_store,
+                                  restart=options.get('restart', False),
+                                  page_size=options.get('page-size'),
+                                  progress=progress)
+    print
+    for source_id, (from_count, to_count) in sorted(mismatched.iteritems()):
+        print '  ! {0}: {1} events in {2}, {3} in {4}'.format(source_id, from_count, from_store, to_count, to_store)
+    if mismatched:
+        sys.exit(1)
+    print 'Event counts match for all sources.'
 
-    class MigratingSource(object):
-        def __init__(self, id, config):
-            self.source_id = id
-            self.config = config
-            self.kind = self.config['kind']
 
-    sources = from_store.get_sources()
-    for source_id, source_data in sources.iteritems():
-        to_store.store_source(MigratingSource(source_id, source_data))
+@command()
+def recode(app):
+    """recode: Rewrites all stored values with the configured codec (BEEN_REDIS_CODEC). Redis only."""
+    if not hasattr(app.store, 'recode'):
+        print 'The current storage engine does not support recoding.'
+        sys.exit(1)
+    print 'Recoded {0} values as {1}.'.format(app.store.recode(), app.store.codec.spec)
+
+
+@command()
+def export(app, path=None, *args):
+    """export <path> (--after TIME) (--cursor CURSOR): Writes all sources and events to <path> ("-" for stdout) as gzipped JSON lines. --after (Unix time or YYYY-MM-DD) or the --cursor printed by a previous export limit it to newer events."""
+    from been import transfer
+    if path is None:
+        print export.__doc__
+        sys.exit(1)
+    args, options = parse_options(args, takes_value=('after', 'cursor'))
+    out = sys.stdout if path == '-' else open(path, 'wb')
+    count, cursor = transfer.export(app.store, out,
+                                    after=parse_time(options.get('after')),
+                                    cursor=options.get('cursor'))
+    if out is not sys.stdout:
+        out.close()
+    print >>sys.stderr, 'Exported {0} events. Next: --cursor {1}'.format(count, cursor)
+
+
+@command(name='import')
+def import_(app, path=None):
+    """import <path>: Reads sources and events written by "export" from <path> ("-" for stdin). Events already stored are left unchanged."""
+    from been import transfer
+    if path is None:
+        print import_.__doc__
+        sys.exit(1)
+
+    def progress(count):
+        sys.stdout.write('\rRead {0} events'.format(count))
+        sys.stdout.flush()
 
-    to_store.store_events(list(from_store.events(count=sys.maxint)))
+    fileobj = sys.stdin if path == '-' else open(path, 'rb')
+    count, changed = transfer.import_(app.store, fileobj, progress=progress)
+    print '\rImported {0} events ({1} added or changed).'.format(count, changed)
 
 
 @command()
@@ -182,6 +426,17 @@ def publish(app, source_name, *args):
     update(app, source_id)
 
 
+@command()
+def bench(app, name=None, *args):
+    """bench <name> (arguments): Runs a benchmark. Run without a name to list them."""
+    from been.bench import benchmarks
+    if name is None:
+        for name, f in sorted(benchmarks.iteritems()):
+            print '  ' + f.__doc__
+        return
+    disambiguate(name, benchmarks, 'benchmark')(app, *args)
+
+
 @command()
 def help(app, cmd=None):
     """help (command): I think you know what this does already."""
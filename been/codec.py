@@ -0,0 +1,106 @@
+import json
+import pickle
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Encoded values start with this tag, followed by one character each for the
+# format and the compression. Values without it are legacy pickles.
+TAG = 'BN1'
+
+FORMAT_TAGS = {'json': 'j', 'msgpack': 'm'}
+COMPRESSION_TAGS = {None: '-', 'zlib': 'z', 'zstd': 's'}
+FORMATS = dict((tag, name) for name, tag in FORMAT_TAGS.iteritems())
+COMPRESSIONS = dict((tag, name) for name, tag in COMPRESSION_TAGS.iteritems())
+
+
+def _default(value):
+    """Serializes values that JSON and msgpack do not handle natively."""
+    return unicode(value)
+
+
+def _dumps(format, value):
+    if format == 'json':
+        return json.dumps(value, separators=(',', ':'), default=_default)
+    elif format == 'msgpack':
+        return msgpack.packb(value, use_bin_type=True, default=_default)
+
+
+def _loads(format, data):
+    if format == 'json':
+        return json.loads(data)
+    elif format == 'msgpack':
+        return msgpack.unpackb(data, raw=False)
+
+
+def _compress(compression, data):
+    if compression == 'zlib':
+        return zlib.compress(data)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def _decompress(compression, data):
+    if compression == 'zlib':
+        return zlib.decompress(data)
+    elif compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class Codec(object):
+    """Serializes stored values as JSON or msgpack, compressing them with zlib
+    or zstd when they are larger than `threshold` bytes. The "pickle" format
+    writes untagged pickles, the legacy encoding."""
+    def __init__(self, format='json', compression='zlib', threshold=1024):
+        if format == 'msgpack' and msgpack is None:
+            raise ImportError('the msgpack codec requires the msgpack package')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        self.format = format
+        self.compression = compression
+        self.threshold = threshold
+
+    @classmethod
+    def from_spec(cls, spec, threshold=1024):
+        """Creates a codec from a "format+compression" string such as "json+zlib"."""
+        format, _, compression = spec.partition('+')
+        return cls(format, compression or None, threshold)
+
+    @property
+    def spec(self):
+        return self.format + ('+' + self.compression if self.compression else '')
+
+    def encode(self, value):
+        if self.format == 'pickle':
+            return pickle.dumps(value)
+
+        data = _dumps(self.format, value)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        compression = self.compression if len(data) > self.threshold else None
+        return ''.join((
+            TAG,
+            FORMAT_TAGS[self.format],
+            COMPRESSION_TAGS[compression],
+            _compress(compression, data),
+        ))
+
+
+def decode(data):
+    """Decodes a value written by any codec, including legacy pickles."""
+    if not data.startswith(TAG):
+        return pickle.loads(data)
+    format, compression = FORMATS[data[3]], COMPRESSIONS[data[4]]
+    return _loads(format, _decompress(compression, data[5:]))
@@ -0,0 +1,93 @@
+import random
+import time
+
+
+class Scheduler(object):
+    """Polls each source on its own adaptive schedule.
+
+    A source's polling interval halves when a fetch brings new events and
+    doubles when it brings none (including when the feed reports itself
+    unmodified via the stored etag/modified validators), within the
+    source's "min_interval" and "max_interval" config values. Errors back
+    off exponentially without changing the interval. Each source's schedule
+    is kept in the store's "schedule:<source id>" state, apart from the
+    source's config, so it persists across restarts without saving a
+    config that a fetch may be changing.
+
+    A source whose fetch timed out is not polled again until that fetch
+    has finished."""
+    min_interval = 5 * 60
+    max_interval = 24 * 60 * 60
+    default_interval = 60 * 60
+    jitter = 0.1
+    # Sources found overdue on startup are spread over this many seconds.
+    startup_spread = 5 * 60
+
+    def __init__(self, app, jobs=4):
+        self.app = app
+        self.jobs = jobs
+        self.schedules = {}
+
+    def schedule(self, source):
+        schedule = self.schedules.get(source.source_id)
+        if schedule is None:
+            # Schedules used to be kept in the source config.
+            schedule = self.schedules[source.source_id] = (
+                self.app.store.get_state('schedule:' + source.source_id) or
+                source.config.get('schedule') or
+                {'interval': self.default_interval, 'next': 0, 'errors': 0})
+        return schedule
+
+    def bounds(self, source):
+        return (source.config.get('min_interval', self.min_interval),
+                source.config.get('max_interval', self.max_interval))
+
+    def reschedule(self, source, now, delay):
+        schedule = self.schedule(source)
+        schedule['next'] = now + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.app.store.store_state('schedule:' + source.source_id, schedule)
+
+    def record(self, source, now, changed=None, error=None):
+        schedule = self.schedule(source)
+        low, high = self.bounds(source)
+        if error is not None:
+            schedule['errors'] += 1
+            delay = min(schedule['interval'] * 2 ** schedule['errors'], high)
+        else:
+            schedule['errors'] = 0
+            if changed:
+                schedule['interval'] = max(schedule['interval'] / 2, low)
+            else:
+                schedule['interval'] = min(schedule['interval'] * 2, high)
+            delay = schedule['interval']
+        self.reschedule(source, now, delay)
+
+    def stagger(self, now):
+        """Spreads out sources that came due while the daemon was stopped."""
+        for source in self.app.sources.itervalues():
+            if self.schedule(source)['next'] <= now:
+                self.reschedule(source, now, random.uniform(0, self.startup_spread))
+
+    def run(self):
+        """Polls sources as they come due, forever. Yields the change counts
+        and errors of each round of updates."""
+        self.stagger(time.time())
+        while True:
+            now = time.time()
+            idle = [source for source in self.app.sources.itervalues()
+                    if source.source_id not in self.app.fetching]
+            due = [source for source in idle if self.schedule(source)['next'] <= now]
+
+            if due:
+                changed = self.app.update_parallel(due, self.jobs)
+                now = time.time()
+                for source in due:
+                    self.record(source, now,
+                                changed=changed.get(source.source_id),
+                                error=self.app.errors.get(source.source_id))
+                yield changed, self.app.errors
+
+            # Check back soon on sources whose timed out fetch is still running.
+            next_due = min([self.schedule(source)['next'] for source in idle] +
+                           [now + (5 if self.app.fetching else 60)])
+            time.sleep(max(0, min(next_due - time.time(), 60)))
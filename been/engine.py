@@ -0,0 +1,187 @@
+import Queue
+import threading
+import time
+import urlparse
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from been import stats
+from been.sources import FeedSource, adopt, create_source, detach
+from been.util import process_pool
+
+
+def source_host(source):
+    """Returns the network host a source fetches from, or None for local sources."""
+    return urlparse.urlparse(source.config.get('url', '')).netloc or None
+
+
+class Dispatcher(object):
+    """Runs a job for each of a list of sources, each on a thread of its own,
+    at most `limits[group]` at once for each group of sources and at most
+    `host_limit` at once against one network host.
+
+    Jobs are given a detached copy of their source (see sources.detach)
+    with a deadline `timeout` seconds (or the source's "timeout" config)
+    after they start. A job still running then is given up on: it stops
+    counting towards the limits and its result is dropped, and as it works
+    on a copy it cannot change the source. The ids of sources whose jobs
+    are running (including those given up on) are kept in `busy`, and
+    sources still busy from an earlier run are skipped."""
+    def __init__(self, limits, host_limit, timeout, busy=None):
+        self.limits = limits
+        self.host_limit = host_limit
+        self.timeout = timeout
+        self.busy = busy if busy is not None else set()
+
+    def run(self, sources, job, group=lambda source: None):
+        """Yields (source, worker, result, error) as jobs finish or time out,
+        where worker is the copy of the source that job(worker) returned
+        `result` for, and error is the exception raised or a message."""
+        results = Queue.Queue()
+        waiting = []
+        for source in sources:
+            if source.source_id in self.busy:
+                yield source, None, None, 'previous fetch still running'
+            else:
+                waiting.append(source)
+        running = {}
+        counts = defaultdict(int)
+
+        def work(worker):
+            try:
+                results.put((worker, job(worker), None))
+            except Exception, e:
+                results.put((worker, None, e))
+            finally:
+                self.busy.discard(worker.source_id)
+
+        def finish(source_id):
+            source, worker, keys = running.pop(source_id)
+            for key in keys:
+                counts[key] -= 1
+            return source
+
+        while waiting or running:
+            for source in list(waiting):
+                host = source_host(source)
+                keys = [('group', group(source))] + ([('host', host)] if host else [])
+                if (counts[keys[0]] >= self.limits[group(source)] or
+                        (host and counts[keys[1]] >= self.host_limit)):
+                    continue
+                waiting.remove(source)
+                worker = detach(source)
+                worker.deadline = time.time() + source.config.get('timeout', self.timeout)
+                running[source.source_id] = (source, worker, keys)
+                for key in keys:
+                    counts[key] += 1
+                self.busy.add(source.source_id)
+                thread = threading.Thread(target=work, args=(worker,))
+                thread.daemon = True
+                thread.start()
+
+            try:
+                worker, result, error = results.get(timeout=1)
+            except Queue.Empty:
+                pass
+            else:
+                if worker.source_id in running and running[worker.source_id][1] is worker:
+                    yield finish(worker.source_id), worker, result, error
+
+            now = time.time()
+            for source_id, (source, worker, keys) in running.items():
+                if now > worker.deadline:
+                    yield finish(source_id), worker, None, 'timed out after {0}s'.format(
+                        source.config.get('timeout', self.timeout))
+
+
+def _parse_feed(args):
+    """Parses a fetched feed in a worker process. Returns its events, the
+    source config (since parsing advances the source's fetch state) and a
+    record of the parsing stats, or the exception raised."""
+    source_data, response, full = args
+    try:
+        source = create_source(source_data)
+        source_stats = stats.SourceStats(source.source_id)
+        with stats.collect(source_stats):
+            events = list(source.parse_response(response, full))
+        return events, source.config, source_stats.record()
+    except Exception, e:
+        return e
+
+
+class UpdateEngine(object):
+    """Updates many sources at once, storing each source's events as soon as
+    it completes.
+
+    Feeds are updated concurrently, at most `concurrency` at a time and at
+    most `host_limit` against one host. Each fetched feed is handed to a
+    parsing executor (`parse_processes` worker processes, or a single
+    thread), so that parsing does not hold up other fetches. Other sources
+    (git, directories) are fetched `local_workers` at a time. Sources are
+    given up on after `timeout` seconds (or their "timeout" config), as in
+    Dispatcher. Failed sources are recorded in self.errors, and the
+    stats.SourceStats of each source in self.stats."""
+    def __init__(self, store, concurrency=32, parse_processes=None, local_workers=2,
+                 host_limit=2, timeout=120, busy=None):
+        self.store = store
+        self.concurrency = concurrency
+        self.parse_processes = parse_processes
+        self.local_workers = local_workers
+        self.host_limit = host_limit
+        self.timeout = timeout
+        self.busy = busy if busy is not None else set()
+        self.errors = {}
+        self.stats = {}
+
+    def run(self, sources, full=False):
+        sources = list(sources)
+        self.stats = stats.start(sources)
+        if self.parse_processes > 1:
+            parse_pool = process_pool(self.parse_processes)
+        else:
+            parse_pool = ThreadPool(1)
+
+        def parse(worker, response):
+            with stats.collect(self.stats[worker.source_id]):
+                return list(worker.parse_response(response, full))
+
+        def update_feed(worker):
+            with stats.collect(self.stats[worker.source_id]):
+                response = worker.fetch_response(full)
+            # Results that never arrive are given up on at the deadline.
+            if not self.parse_processes > 1:
+                return parse_pool.apply_async(parse, (worker, response)).get(worker.time_left())
+            outcome = parse_pool.apply_async(_parse_feed, ((worker.config, response, full),)).get(worker.time_left())
+            if isinstance(outcome, Exception):
+                raise outcome
+            events, config, record = outcome
+            worker.config.update(config)
+            self.stats[worker.source_id].merge(record)
+            return events
+
+        def update_local(worker):
+            with stats.collect(self.stats[worker.source_id]):
+                return list(worker.fetch(full))
+
+        def job(worker):
+            return update_feed(worker) if isinstance(worker, FeedSource) else update_local(worker)
+
+        dispatcher = Dispatcher({'feed': self.concurrency, 'local': self.local_workers},
+                                self.host_limit, self.timeout, self.busy)
+        changed = {}
+        self.errors = {}
+        for source, worker, events, error in dispatcher.run(
+                sources, job, lambda source: 'feed' if isinstance(source, FeedSource) else 'local'):
+            if error:
+                self.errors[source.source_id] = error
+                self.stats[source.source_id].fail(error)
+                continue
+            adopt(source, worker)
+            with stats.collect(self.stats[source.source_id]):
+                changed[source.source_id] = self.store.store_update(source, events)
+
+        if not self.parse_processes > 1:
+            # The process pool is shared, but the parsing thread is ours.
+            parse_pool.close()
+
+        return changed
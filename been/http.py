@@ -0,0 +1,196 @@
+import httplib
+import os
+import pickle
+import socket
+import threading
+import time
+import urlparse
+import zlib
+from collections import defaultdict
+from email.utils import mktime_tz, parsedate_tz
+from hashlib import sha1
+
+
+def parse_http_date(value):
+    """Converts an HTTP date header to a Unix timestamp, or None if invalid."""
+    parsed = parsedate_tz(value or '')
+    return mktime_tz(parsed) if parsed else None
+
+
+def decode_body(body, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header.
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def freshness_lifetime(headers):
+    """Returns how many seconds a response may be served from cache, or None
+    if it must not be stored at all."""
+    directives = {}
+    for directive in headers.get('cache-control', '').split(','):
+        key, _, value = directive.strip().partition('=')
+        directives[key.lower()] = value.strip('"')
+
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+
+    age = int(headers.get('age', 0) or 0)
+    if directives.get('max-age', '').isdigit():
+        return max(int(directives['max-age']) - age, 0)
+
+    expires = parse_http_date(headers.get('expires'))
+    if expires is not None:
+        date = parse_http_date(headers.get('date')) or time.time()
+        return max(expires - date - age, 0)
+
+    return 0
+
+
+class Response(object):
+    def __init__(self, url, status, headers, body, from_cache=False, transferred=0):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.from_cache = from_cache
+        # Bytes received over the network, before decompression.
+        self.transferred = transferred
+
+
+class HTTPClient(object):
+    """Fetches URLs over pooled keep-alive connections, negotiating gzip and
+    deflate encoding. Responses are cached on disk (if cache_dir is set) for
+    as long as their Cache-Control or Expires headers allow. Each Response
+    records the bytes transferred to fetch it."""
+    max_redirects = 5
+
+    def __init__(self, cache_dir=None, max_idle=4):
+        self.cache_dir = cache_dir
+        self.max_idle = max_idle
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, sha1(url).hexdigest())
+
+    def _cache_get(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url), 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if entry['expires'] <= time.time():
+            return None
+        return Response(url, entry['status'], entry['headers'], entry['body'], from_cache=True)
+
+    def _cache_put(self, url, response):
+        lifetime = freshness_lifetime(response.headers)
+        if not self.cache_dir or not lifetime or response.status != 200:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._cache_path(url)
+        tmp_path = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'status': response.status,
+                'headers': response.headers,
+                'body': response.body,
+                'expires': time.time() + lifetime,
+            }, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def _connection(self, scheme, netloc, timeout):
+        with self.lock:
+            idle = self.idle[scheme, netloc]
+            if idle:
+                conn = idle.pop()
+                # The socket keeps the timeout of the request that opened it.
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return cls(netloc, timeout=timeout), False
+
+    def _release(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle[scheme, netloc]
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self.lock:
+            for idle in self.idle.itervalues():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def _request(self, url, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers = dict(headers, **{'Accept-Encoding': 'gzip, deflate'})
+
+        while True:
+            conn, reused = self._connection(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # The server may have dropped an idle connection; retry on a new one.
+                    continue
+                raise
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(parts.scheme, parts.netloc, conn)
+
+        response_headers = dict(resp.getheaders())
+        return Response(url, resp.status, response_headers,
+                        decode_body(body, response_headers.get('content-encoding')),
+                        transferred=len(body))
+
+    def get(self, url, headers=None, timeout=None, cache=True):
+        """Returns the Response for url, following redirects. Pass
+        cache=False to bypass the cache for this request."""
+        requested, transferred = url, 0
+        for _ in xrange(self.max_redirects + 1):
+            response = self._cache_get(url) if cache else None
+            if response:
+                return response
+
+            response = self._request(url, headers or {}, timeout)
+            transferred += response.transferred
+            response.transferred = transferred
+            if response.status in (301, 302, 303, 307, 308) and 'location' in response.headers:
+                url = urlparse.urljoin(url, response.headers['location'])
+                continue
+
+            self._cache_put(requested, response)
+            return response
+
+        raise httplib.HTTPException('too many redirects fetching {0!r}'.format(url))
+
+
+client = HTTPClient(cache_dir=os.environ.get(
+    'BEEN_HTTP_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'been', 'http'),
+) or None)
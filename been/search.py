@@ -0,0 +1,72 @@
+import math
+import re
+import unicodedata
+from collections import defaultdict
+
+
+MARKUP = re.compile(r'<[^>]*>|&#?\w+;')
+WORD = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = frozenset('a an and are as at be by for from has have i in is it its of on or that the this to was with'.split())
+
+# How much an occurrence of a word counts in each field of an event.
+FIELD_WEIGHTS = (
+    ('summary', 3),
+    ('title', 3),
+    ('content', 1),
+)
+META_WEIGHT = 2
+
+
+def tokenize(text):
+    """Splits text (which may contain HTML) into lowercase words, with accents
+    and stopwords removed."""
+    text = unicodedata.normalize('NFKD', MARKUP.sub(' ', unicode(text)).lower())
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return [word for word in WORD.findall(text) if len(word) > 1 and word not in STOPWORDS]
+
+
+def texts(value):
+    """Returns the strings of a field, which may hold one or a list of
+    them (feed content is stored as a tuple, and read back as a list)."""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [value for value in values if isinstance(value, basestring)]
+
+
+def event_terms(event):
+    """Returns the weight of each word in an event's summary, title, content
+    and metadata (such as markdown tags)."""
+    counts = defaultdict(int)
+    for field, weight in FIELD_WEIGHTS:
+        for text in texts(event.get(field)):
+            for word in tokenize(text):
+                counts[word] += weight
+    for values in (event.get('meta') or {}).itervalues():
+        for text in texts(values):
+            for word in tokenize(text):
+                counts[word] += META_WEIGHT
+    # Dampen repetition, so that long posts do not drown out short events.
+    return dict((word, round(1 + math.log(count), 3)) for word, count in counts.iteritems())
+
+
+def query_terms(query):
+    return sorted(set(tokenize(query)))
+
+
+def idf(total, frequency):
+    """Weighs a word by how rare it is among `total` events."""
+    return math.log(1 + total / float(frequency))
+
+
+def rank(postings, total):
+    """Scores the events containing every word of a query, given the
+    {word: {event id: weight}} postings of each word. Returns (score, id)
+    pairs, best first."""
+    if not postings or not all(postings.itervalues()):
+        return []
+    words = sorted(postings, key=lambda word: len(postings[word]))
+    ids = set(postings[words[0]])
+    for word in words[1:]:
+        ids.intersection_update(postings[word])
+    weights = dict((word, idf(total, len(postings[word]))) for word in words)
+    return sorted(((sum(postings[word][_id] * weights[word] for word in words), _id) for _id in ids),
+                  reverse=True)
@@ -1,12 +1,18 @@
+import calendar
+import copy
 import os
 import re
 import subprocess
+import threading
 import time
 import unicodedata
+from collections import deque
+from email.utils import formatdate
 from hashlib import sha1
 
-import feedparser
-import markdown
+from been import http, stats
+from been.http import parse_http_date
+from been.util import LRUCache, batches, ordered_map, process_pool
 
 
 source_map = {}
@@ -24,6 +30,65 @@ def create_source(source_data):
     return source_map[source_data['kind']](source_data)
 
 
+def _process_batch(args):
+    """Runs process_event on a batch of events in a worker process."""
+    source_data, events = args
+    source = create_source(source_data)
+    return [source.process_event(event) for event in events]
+
+
+def worker_config(source):
+    """Returns a source's settings without its bulky fetch state, which
+    worker processes do not need."""
+    return dict((key, value) for key, value in source.config.iteritems()
+                if key not in ('manifest', 'first_added'))
+
+
+def process_batches(work, processes):
+    """Yields the processed events of (source config, events) batches, run
+    on a pool of worker processes. Results are yielded in input order."""
+    for results in ordered_map(process_pool(processes), _process_batch, work, window=processes * 2):
+        for event in results:
+            yield event
+
+
+def detach(source):
+    """Returns a copy of a source with its own copy of the config, so that a
+    fetch can run in the background without changing the source's fetch
+    state unless its result is accepted (see adopt)."""
+    worker = copy.copy(source)
+    worker.config = copy.deepcopy(source.config)
+    return worker
+
+
+def adopt(source, worker):
+    """Takes on the fetch state that a detached copy of a source reached."""
+    source.config.update(worker.config)
+    source.removed = worker.removed
+
+
+def run_process(args, timeout=None):
+    """Runs a command, returning its exit status and output. The command is
+    killed if it runs for longer than `timeout` seconds."""
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    timer = None
+    if timeout is not None:
+        def kill():
+            try:
+                process.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        if timer:
+            timer.cancel()
+    return process.returncode, output
+
+
 # slugify from Django source (BSD license)
 def slugify(value):
     value = unicodedata.normalize('NFKD', unicode(value)).encode('ascii', 'ignore')
@@ -32,41 +97,108 @@ def slugify(value):
 
 
 class Source(object):
+    # Ids of previously fetched events that no longer exist at the source,
+    # set by fetch() for sources that can detect deletions.
+    removed = ()
+    # The time by which the current fetch must finish, if it has a deadline.
+    deadline = None
+
     def __init__(self, config=None):
         self.config = config or {}
         self.config['kind'] = self.kind
 
-    def fetch(self): raise NotImplementedError
-
+    def time_left(self, timeout=None):
+        """Returns the timeout to give a network request or subprocess: at
+        most `timeout`, and no later than the fetch's deadline."""
+        if self.deadline is None:
+            return timeout
+        left = max(self.deadline - time.time(), 0.1)
+        return left if timeout is None else min(timeout, left)
 
-class DirectorySource(Source):
-    def _fetch_path(self, path):
-        events = []
+    def fetch(self, full=False):
+        """Returns or yields new events. Incremental sources skip what earlier
+        fetches already returned unless `full` is set."""
+        raise NotImplementedError
 
-        for filename in os.listdir(path):
-            full_path = os.path.join(path, filename)
+    def process_event(self, event):
+        return event
 
-            if not os.path.isfile(full_path):
-                continue
+    def process_events(self, events, processes=None):
+        """Yields the result of process_event for each event, in order."""
+        for event in events:
+            with stats.phase('process'):
+                event = self.process_event(event)
+            yield event
 
-            with open(full_path) as f:
-                raw = f.read().decode('utf-8')
 
-            event = {
-                'filename'  : filename,
-                'full_path' : full_path,
-                'raw'       : raw,
-                'timestamp' : time.gmtime(os.path.getmtime(full_path)),
-            }
+class DirectorySource(Source):
+    def _fetch_path(self, path, full=False):
+        """Yields events for files in path that changed since the last fetch.
+
+        A manifest of each file's mtime, size, and content hash is kept in the
+        source config. Files matching their manifest entry are skipped (unless
+        `full` is set), and the events of files that disappeared are listed in
+        self.removed. Files that process_event() deferred (returned None for)
+        are left out of the manifest, so they are read again, and are listed
+        in the "deferred" config value."""
+        manifest = self.config.get('manifest', {})
+        seen = {}
+        read = deque()  # (filename, manifest entry) of files read, in order
+
+        def read_changed():
+            for filename in os.listdir(path):
+                full_path = os.path.join(path, filename)
+
+                if not os.path.isfile(full_path):
+                    continue
+
+                with stats.phase('fetch'):
+                    stat = os.stat(full_path)
+                    entry = None if full else manifest.get(filename)
+                    if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                        seen[filename] = entry
+                        continue
+
+                    with open(full_path) as f:
+                        raw = f.read()
+                stats.count('fetched_bytes', len(raw))
+
+                digest = sha1(raw).hexdigest()
+                if entry and entry['hash'] == digest:
+                    # Touched but not modified.
+                    entry.update(mtime=stat.st_mtime, size=stat.st_size)
+                    seen[filename] = entry
+                    continue
+
+                read.append((filename, {
+                    'mtime' : stat.st_mtime,
+                    'size'  : stat.st_size,
+                    'hash'  : digest,
+                }))
+                yield {
+                    'filename'  : filename,
+                    'full_path' : full_path,
+                    'raw'       : raw.decode('utf-8'),
+                    'timestamp' : time.gmtime(stat.st_mtime),
+                }
 
-            event = self.process_event(event)
+        deferred = []
+        for event in self.process_events(read_changed()):
+            filename, entry = read.popleft()
             if event:
-                events.append(event)
+                entry['_id'] = event.get('_id')
+                seen[filename] = entry
+                yield event
+            else:
+                deferred.append(filename)
 
-        return events
+        self.removed = [entry['_id'] for filename, entry in manifest.iteritems()
+                        if filename not in seen and entry.get('_id')]
+        self.config['manifest'] = seen
+        self.config['deferred'] = deferred
 
-    def fetch(self):
-        return self._fetch_path(self.config['path'])
+    def fetch(self, full=False):
+        return self._fetch_path(self.config['path'], full)
 
     def process_event(self, event):
         return event
@@ -81,35 +213,76 @@ class DirectorySource(Source):
 
 
 class GitDirectorySource(DirectorySource):
-    def fetch(self):
-        subprocess.check_call([
-            'git',
-            '-C', self.config['path'],
-            'pull',
-            '--quiet',
-        ])
+    def _git(self, *args):
+        command = ['git', '-C', self.config['path']] + list(args)
+        status, output = run_process(command, self.time_left())
+        if status:
+            raise subprocess.CalledProcessError(status, command, output)
+        return output
+
+    def _index_history(self, first_added, since=None):
+        """Records the date of the first commit adding each file, following
+        renames, in a single pass over the history (or just since..HEAD)."""
+        args = [
+            '-c', 'core.quotepath=off',
+            'log', '--reverse', '--name-status', '-M', '--format=%x00%at',
+        ]
+        if since:
+            args.append(since + '..HEAD')
+        args += ['--', self.config['subdirectory'] or '.']
+
+        timestamp = None
+        for line in self._git(*args).split('\n'):
+            if line.startswith('\x00'):
+                timestamp = int(line[1:])
+                continue
+
+            fields = line.split('\t')
+            if len(fields) < 2:
+                continue
+
+            status = fields[0][0]
+            if status in 'AC':
+                first_added.setdefault(fields[-1], timestamp)
+            elif status == 'R':
+                first_added.setdefault(fields[2], first_added.get(fields[1], timestamp))
+
+        return first_added
+
+    def fetch(self, full=False):
+        with stats.phase('fetch'):
+            self._git('pull', '--quiet')
+
+            head = self._git('rev-parse', 'HEAD').strip()
+            last_head = self.config.get('head')
+            # Deferred files (such as posts published in the future) may be
+            # due without any new commit.
+            if head == last_head and not full and not self.config.get('deferred'):
+                self.removed = []
+                return
+
+            first_added = self.config.get('first_added', {})
+            if full or not last_head or run_process(['git', '-C', self.config['path'],
+                    'merge-base', '--is-ancestor', last_head, head], self.time_left())[0] != 0:
+                # No usable index, or history was rewritten: walk everything.
+                first_added, last_head = {}, None
+            self._index_history(first_added, since=last_head)
 
         events = self._fetch_path(os.path.join(
             self.config['path'],
             self.config['subdirectory'],
-        ))
+        ), full)
 
         # use the date of the first commit adding each file
         for event in events:
-            output = subprocess.check_output([
-                'git',
-                '-C', self.config['path'],
-                'log', '--follow', '--format=%at',
-                event['full_path'],
-            ])
-            try:
-                first_date = int(output.strip().split('\n')[-1])
-            except ValueError:
-                raise ValueError('invalid git log output for {!r}: {!r}'
-                        .format(event['full_path'], output))
-            event['timestamp'] = time.gmtime(first_date)
+            path = os.path.relpath(event['full_path'], self.config['path'])
+            if path not in first_added:
+                raise ValueError('no git history for {!r}'.format(event['full_path']))
+            event['timestamp'] = time.gmtime(first_added[path])
+            yield event
 
-        return events
+        self.config['head'] = head
+        self.config['first_added'] = first_added
 
 
     @property
@@ -124,20 +297,89 @@ class GitDirectorySource(DirectorySource):
         })
 
 
+def entry_timestamp(entry):
+    timestamp = entry.get('published_parsed') or entry.get('updated_parsed')
+    return calendar.timegm(timestamp) if timestamp else None
+
+
+def entry_id(entry):
+    return entry.get('id') or entry.get('link') or entry.get('title')
+
+
 class FeedSource(Source):
-    def fetch(self):
-        since = self.config.get('since', {})
-        feed = feedparser.parse(self.config['url'],
-                modified = time.gmtime(since['modified'])
-                            if since.get('modified')
-                            else None,
-                etag = since.get('etag'))
-
-        if feed.status == 304 or feed.status >= 400:
-            return []
+    def new_entries(self, entries):
+        """Filters out entries at or below the stored high-water mark, the
+        newest timestamp (and the ids at that timestamp) seen so far, and
+        advances the mark. Entries without a timestamp are always kept."""
+        seen = self.config.get('seen', {})
+        mark, mark_ids = seen.get('timestamp'), set(seen.get('ids', []))
+
+        new = []
+        newest, newest_ids = mark, set(mark_ids)
+        for entry in entries:
+            timestamp = entry_timestamp(entry)
+            if timestamp is None:
+                new.append(entry)
+                continue
+
+            if mark is None or timestamp > mark or (timestamp == mark and entry_id(entry) not in mark_ids):
+                new.append(entry)
+
+            if newest is None or timestamp > newest:
+                newest, newest_ids = timestamp, set()
+            if timestamp == newest:
+                newest_ids.add(entry_id(entry))
+
+        if newest is not None:
+            self.config['seen'] = {'timestamp': newest, 'ids': sorted(newest_ids)}
+        return new
+
+    def fetch(self, full=False):
+        return self.parse_response(self.fetch_response(full), full)
+
+    def fetch_response(self, full=False):
+        """Requests the feed, returning an http.Response."""
+        since = {} if full else self.config.get('since', {})
+        headers = {}
+        if since.get('etag'):
+            headers['If-None-Match'] = since['etag']
+        if isinstance(since.get('modified'), (int, long, float)):
+            headers['If-Modified-Since'] = formatdate(since['modified'], usegmt=True)
+
+        with stats.phase('fetch'):
+            response = http.client.get(self.config['url'], headers,
+                                       timeout=self.time_left(self.config.get('timeout', 60)),
+                                       cache=not full)
+
+        http_stats = self.config.setdefault('http', {'bytes': 0, 'hits': 0, 'misses': 0})
+        http_stats['bytes'] += response.transferred
+        http_stats['hits' if response.from_cache else 'misses'] += 1
+        stats.count('requests')
+        stats.count('fetched_bytes', response.transferred)
+        if response.from_cache or response.status == 304:
+            stats.count('not_modified')
+        return response
+
+    def parse_response(self, response, full=False):
+        """Yields events for the new entries of a fetched feed."""
+        # A fresh cached response was already processed by an earlier fetch.
+        if response.from_cache or response.status == 304 or response.status >= 400:
+            return
         else:
-            events = []
-            for entry in feed.entries:
+            with stats.phase('parse'):
+                import feedparser
+                # The body was already decoded, so feedparser must not decode it again.
+                headers = dict((name, value) for name, value in response.headers.iteritems()
+                               if name.lower() != 'content-encoding')
+                headers['content-location'] = response.url
+                feed = feedparser.parse(response.body, response_headers=headers)
+
+            # The high-water mark advances even when backfilling.
+            entries = self.new_entries(feed.entries)
+            if full:
+                entries = feed.entries
+
+            for entry in entries:
                 event = {
                     'author': entry.get('author'),
                     'summary': entry.get('title'),
@@ -149,12 +391,15 @@ class FeedSource(Source):
                 if 'content' in entry:
                     event['content'] = entry.get('content')[0]['value'],
 
-                event = self.process_event(event)
+                with stats.phase('process'):
+                    event = self.process_event(event)
                 if event:
-                    events.append(event)
+                    yield event
 
-            self.config['since'] = {'etag': feed.get('etag'), 'modified': feed.get('modified_parsed') or feed.get('modified')}
-            return events
+            self.config['since'] = {
+                'etag': response.headers.get('etag'),
+                'modified': parse_http_date(response.headers.get('last-modified')),
+            }
 
     def process_event(self, event):
         return event
@@ -237,27 +482,81 @@ class LastFMSource(SiteFeedSource):
         return event
 
 
+# Markdown converters are reused between documents, one per thread.
+_converters = threading.local()
+
+
 class MarkdownProcessor(object):
+    markdown_extensions = ('meta', 'tables', 'fenced_code', 'headerid')
+
+    # Rendered (content, meta) pairs by render key, shared by all sources.
+    render_cache = LRUCache(1024)
+
+    def render_key(self, raw):
+        """Hashes a document with the markdown version and extension list, so
+        that changing either invalidates previously rendered output."""
+        import markdown
+        version = markdown.version + repr(self.markdown_extensions)
+        return sha1(version + '\0' + raw.encode('utf-8')).hexdigest()
+
+    def render(self, raw, key=None):
+        """Returns the HTML content and metadata of a markdown document."""
+        key = key or self.render_key(raw)
+        rendered = self.render_cache.get(key)
+        if rendered is None:
+            md = getattr(_converters, 'md', None)
+            if md is None or _converters.extensions != self.markdown_extensions:
+                import markdown
+                md = _converters.md = markdown.Markdown(extensions=list(self.markdown_extensions))
+                _converters.extensions = self.markdown_extensions
+            content = md.reset().convert(raw)
+            rendered = self.render_cache[key] = (content, md.Meta)
+        return rendered
+
+    def process_events(self, events, processes=None):
+        """Renders events on a pool of worker processes when the "processes"
+        config value (or the processes argument) is greater than 1. Results
+        are yielded in input order, as in serial mode."""
+        processes = processes or self.config.get('processes')
+        if not processes or processes < 2:
+            for event in super(MarkdownProcessor, self).process_events(events):
+                yield event
+            return
+
+        source_data = worker_config(self)
+        batch_size = self.config.get('process_batch_size', 16)
+        work = ((source_data, batch) for batch in batches(events, batch_size))
+        for event in process_batches(work, processes):
+            yield event
+
     def process_event(self, event):
-        md = markdown.Markdown(extensions=['meta', 'tables', 'fenced_code', 'headerid'])
-        event['content'] = md.convert(event['raw'])
+        key = self.render_key(event['raw'])
+        if event.get('render_key') == key and 'content' in event:
+            # Reprocessing a stored event whose source text has not changed.
+            content, meta = event['content'], event['meta']
+        else:
+            content, meta = self.render(event['raw'], key)
+        meta = dict(meta)
+
+        event['content'] = content
+        event['render_key'] = key
         event['filename'] = os.path.splitext(event['filename'])[0]
 
         md_header = re.match(r'^#\w*(.*)\n', event['raw'])
         if md_header:
             event['title'] = md_header.group(1)
-        elif 'title' in md.Meta:
-            event['title'] = ' '.join(md.Meta['title'])
+        elif 'title' in meta:
+            event['title'] = ' '.join(meta['title'])
         else:
             event['title'] = event['filename']
 
-        event['author'] = ' '.join(md.Meta.get('author', ['']))
-        event['slug'] = '-'.join(md.Meta.get('slug', [slugify(event['filename'])]))
+        event['author'] = ' '.join(meta.get('author', ['']))
+        event['slug'] = '-'.join(meta.get('slug', [slugify(event['filename'])]))
         event['summary'] = 'posted ' + event['title']
-        event['meta'] = md.Meta
-        if md.Meta.get('published'):
+        event['meta'] = meta
+        if meta.get('published'):
             # Parse time, then convert struct_time (local) -> epoch (GMT) -> struct_time (GMT)
-            event['timestamp'] = time.gmtime(time.mktime(time.strptime(' '.join(md.Meta.get('published')), '%Y-%m-%d %H:%M:%S')))
+            event['timestamp'] = time.gmtime(time.mktime(time.strptime(' '.join(meta.get('published')), '%Y-%m-%d %H:%M:%S')))
         event['_id'] = sha1(event['full_path'].encode('utf-8')).hexdigest()
         if time.gmtime() < event['timestamp']:
             return None
@@ -286,7 +585,7 @@ class RedditSource(SiteFeedSource):
 @source('twitter')
 class TwitterSource(Source):
 
-    def fetch(self):
+    def fetch(self, full=False):
         import twitter
         api = twitter.Api(
             consumer_key=self.config['consumer_key'],
@@ -342,7 +641,7 @@ class PublishSource(Source):
         kwargs.update(self.config.get('default', {}))
         self.queue.append(kwargs)
 
-    def fetch(self):
+    def fetch(self, full=False):
         events = self.queue
         self.queue = []
         return events
@@ -0,0 +1,214 @@
+import cProfile
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+PHASES = ('fetch', 'parse', 'process', 'serialize', 'store')
+
+# The stats of the source being updated on each thread, if any.
+_active = threading.local()
+
+
+class SourceStats(object):
+    """Timings and sizes of one update of a source.
+
+    Phase times are exclusive: time spent in a phase nested in another (such
+    as serializing while storing) only counts towards the inner one. Time in
+    no phase is reported as "other". If `profile_dir` is set, the update is
+    also run under cProfile and dumped to a file there named after the
+    source."""
+    def __init__(self, source_id, profile_dir=None):
+        self.source_id = source_id
+        self.started = time.time()
+        self.elapsed = 0.0
+        self.phases = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.error = None
+        self.stack = []
+        self.profile_dir = profile_dir
+        self.profile = cProfile.Profile() if profile_dir else None
+
+    def enter(self, name):
+        now = time.time()
+        if self.stack:
+            self.phases[self.stack[-1][0]] += now - self.stack[-1][1]
+        self.stack.append([name, now])
+
+    def exit(self):
+        now = time.time()
+        name, since = self.stack.pop()
+        self.phases[name] += now - since
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def fail(self, error):
+        self.error = error if isinstance(error, basestring) else '{0}: {1}'.format(type(error).__name__, error)
+
+    def merge(self, record):
+        """Adds the phases and counts of a record made elsewhere (e.g. by a
+        worker process) to these."""
+        self.elapsed += record['elapsed']
+        for name, seconds in record['phases'].iteritems():
+            if name != 'other':
+                self.phases[name] += seconds
+        for name, value in record['counts'].iteritems():
+            self.counts[name] += value
+
+    def record(self):
+        phases = dict(self.phases)
+        phases['other'] = max(self.elapsed - sum(phases.itervalues()), 0)
+        return {
+            'time': self.started,
+            'elapsed': self.elapsed,
+            'phases': phases,
+            'counts': dict(self.counts),
+            'error': self.error,
+        }
+
+    def dump_profile(self):
+        if self.profile:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            self.profile.dump_stats(os.path.join(
+                self.profile_dir, re.sub(r'[^\w.-]+', '_', self.source_id) + '.prof'))
+
+
+def start(sources):
+    """Returns fresh stats for each of `sources`, by source id."""
+    profile_dir = os.environ.get('BEEN_PROFILE') or None
+    return dict((source.source_id, SourceStats(source.source_id, profile_dir)) for source in sources)
+
+
+@contextmanager
+def collect(source_stats):
+    """Records the phases and counts of the code run on this thread in the
+    block to `source_stats`."""
+    previous = getattr(_active, 'stats', None)
+    _active.stats = source_stats
+    if source_stats.profile:
+        source_stats.profile.enable()
+    start = time.time()
+    try:
+        yield source_stats
+    except Exception, e:
+        source_stats.fail(e)
+        raise
+    finally:
+        source_stats.elapsed += time.time() - start
+        if source_stats.profile:
+            source_stats.profile.disable()
+        _active.stats = previous
+
+
+@contextmanager
+def phase(name):
+    """Times the block as a phase of the update being collected, if any."""
+    source_stats = getattr(_active, 'stats', None)
+    if source_stats is None:
+        yield
+        return
+    source_stats.enter(name)
+    try:
+        yield
+    finally:
+        source_stats.exit()
+
+
+def count(name, value=1):
+    """Adds to a count of the update being collected, if any."""
+    source_stats = getattr(_active, 'stats', None)
+    if source_stats is not None:
+        source_stats.counts[name] += value
+
+
+def save(store, stats):
+    """Appends the records of updates to the rolling history kept in the
+    store, which holds the last BEEN_STATS_HISTORY updates of each source
+    under a state key of its own."""
+    size = int(os.environ.get('BEEN_STATS_HISTORY', 100))
+    for source_stats in stats:
+        source_stats.dump_profile()
+        runs = store.get_state('stats:' + source_stats.source_id) or []
+        runs.append(source_stats.record())
+        store.store_state('stats:' + source_stats.source_id, runs[-size:])
+
+
+def load(store, source_ids):
+    """Returns the recorded updates of each of `source_ids`, by source id."""
+    return dict((source_id, store.get_state('stats:' + source_id) or []) for source_id in source_ids)
+
+
+def summarize(runs):
+    """Sums up the recorded updates of a source."""
+    totals = defaultdict(int)
+    phases = defaultdict(float)
+    for run in runs:
+        for name, value in run['counts'].iteritems():
+            totals[name] += value
+        for name, seconds in run['phases'].iteritems():
+            phases[name] += seconds
+    requests = totals['requests']
+    return {
+        'updates': len(runs),
+        'errors': sum(1 for run in runs if run['error']),
+        'last': runs[-1],
+        'mean_elapsed': sum(run['elapsed'] for run in runs) / len(runs),
+        'mean_phases': dict((name, seconds / len(runs)) for name, seconds in phases.iteritems()),
+        'totals': dict(totals),
+        'not_modified_ratio': totals['not_modified'] / float(requests) if requests else None,
+    }
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus(history):
+    """Formats the stats history in the Prometheus text exposition format.
+    Values are those of each source's last update, except the counts and
+    ratios over the recorded history."""
+    metrics = [
+        ('been_source_last_update_timestamp_seconds', 'Start time of the last update.'),
+        ('been_source_duration_seconds', 'Duration of the last update.'),
+        ('been_source_phase_seconds', 'Time spent in each phase of the last update.'),
+        ('been_source_fetched_bytes', 'Bytes received over the network by the last update.'),
+        ('been_source_stored_bytes', 'Encoded size of the events the last update serialized for storing.'),
+        ('been_source_events', 'Events fetched by the last update.'),
+        ('been_source_changed_events', 'Events added or changed by the last update.'),
+        ('been_source_updates', 'Updates in the recorded history.'),
+        ('been_source_errors', 'Failed updates in the recorded history.'),
+        ('been_source_not_modified_ratio', 'Share of requests in the recorded history answered "not modified".'),
+    ]
+    samples = defaultdict(list)
+    for source_id, runs in sorted(history.iteritems()):
+        if not runs:
+            continue
+        summary = summarize(runs)
+        last = summary['last']
+        labels = 'source="{0}"'.format(_escape(source_id))
+        add = lambda name, value, extra='': samples[name].append(
+            '{0}{{{1}{2}}} {3!r}'.format(name, labels, extra, float(value)))
+        add('been_source_last_update_timestamp_seconds', last['time'])
+        add('been_source_duration_seconds', last['elapsed'])
+        for name, seconds in sorted(last['phases'].iteritems()):
+            add('been_source_phase_seconds', seconds, ',phase="{0}"'.format(name))
+        add('been_source_fetched_bytes', last['counts'].get('fetched_bytes', 0))
+        add('been_source_stored_bytes', last['counts'].get('stored_bytes', 0))
+        add('been_source_events', last['counts'].get('events', 0))
+        add('been_source_changed_events', last['counts'].get('changed', 0))
+        add('been_source_updates', summary['updates'])
+        add('been_source_errors', summary['errors'])
+        if summary['not_modified_ratio'] is not None:
+            add('been_source_not_modified_ratio', summary['not_modified_ratio'])
+
+    lines = []
+    for name, help in metrics:
+        if samples[name]:
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.extend(samples[name])
+    return '\n'.join(lines) + '\n'
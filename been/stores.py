@@ -1,15 +1,24 @@
+import base64
 import calendar
+import copy
+import json
 import os
-import pickle
+import sqlite3
 import time
+from collections import defaultdict
+from datetime import datetime
 from hashlib import sha1
 
-import couchdb
-import redis
+from been import codec, search, stats
+from been.util import LRUCache, batches
 
 
 def create_store(name):
-    return store_map[name]()
+    store = store_map[name]()
+    cache_size = int(os.environ.get('BEEN_STORE_CACHE', 0))
+    if cache_size:
+        store = CachingStore(store, cache_size, ttl=float(os.environ.get('BEEN_STORE_CACHE_TTL', 60)) or None)
+    return store
 
 
 def dates_to_epoch(d):
@@ -22,55 +31,486 @@ def dates_to_epoch(d):
     return d
 
 
-def unpickle_dict(dict_):
-    """Accepts a dict of pickled items and returns a dict of unpickled items."""
-    return dict((k, pickle.loads(v)) for k, v in dict_.iteritems())
+def prepare_event(event):
+    """Converts an event's dates to timestamps and gives it an id if it has none."""
+    dates_to_epoch(event)
+    event.setdefault('_id', sha1(event['summary'].encode('utf-8')+str(event['timestamp'])).hexdigest())
+    return event
+
+
+def event_fingerprint(event):
+    """Hashes the content of an event, ignoring store bookkeeping fields."""
+    content = dict((k, v) for k, v in event.iteritems() if k not in ('_rev', 'fingerprint'))
+    return sha1(json.dumps(content, sort_keys=True, default=repr)).hexdigest()
+
+
+PERIODS = ('day', 'week', 'month')
+
+
+def time_buckets(timestamp):
+    """Returns the day, ISO week and month (UTC) that a timestamp falls in."""
+    date = datetime.utcfromtimestamp(timestamp)
+    year, week, _ = date.isocalendar()
+    return {
+        'day': date.strftime('%Y-%m-%d'),
+        'week': '{0}-W{1:02d}'.format(year, week),
+        'month': date.strftime('%Y-%m'),
+    }
+
+
+def rollup_keys(source, kind, buckets):
+    """Returns the keys of the rollup counters an event counts towards:
+    (dimension, value) totals per source and kind, and (period, filter,
+    bucket) histograms, where filter is None, "source:<id>" or "kind:<kind>"."""
+    keys = [('source', source), ('kind', kind)]
+    for period in PERIODS:
+        for filter in (None, 'source:' + source, 'kind:' + kind):
+            keys.append((period, filter, buckets[period]))
+    return keys
+
+
+def event_rollup_keys(event):
+    return rollup_keys(event['source'], event.get('kind', ''), time_buckets(event['timestamp']))
+
+
+def encode_cursor(timestamp, _id):
+    """Encodes a (timestamp, id) position as an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps([timestamp, _id]))
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, _id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor: {0!r}'.format(cursor))
+    return timestamp, _id
+
+
+def collapse_interval(config, event):
+    """Returns the interval within which an event is grouped with the
+    previous event of its source, or None if it is not grouped."""
+    collapse = config.get('collapse', False)
+    if collapse is False and not event.get('collapse'):
+        return None
+    if not isinstance(collapse, dict):
+        collapse = {}
+    return collapse.get('interval', 2*60*60)
+
+
+def is_group(entry):
+    return entry['_id'] != entry['children'][0]
+
+
+def timeline_entries(config, events):
+    """Groups a source's events, newest first, into timeline entries.
+
+    An event joins the current group if it occurred within the collapse
+    interval of the group's oldest event. Events that are not collapsed
+    get an entry of their own with the id of the event."""
+    group = None
+    for event in events:
+        interval = collapse_interval(config, event)
+        entry = {
+            '_id': event['_id'],
+            'source': event['source'],
+            'kind': event['kind'],
+            'timestamp': event['timestamp'],
+            'oldest': event['timestamp'],
+            'children': [event['_id']],
+        }
+        if interval is None:
+            yield entry
+        elif group and group['oldest'] - event['timestamp'] <= interval:
+            group['children'].append(event['_id'])
+            group['oldest'] = event['timestamp']
+        else:
+            if group:
+                yield group
+            group = entry
+
+        # Groups are named after their oldest event.
+        if group:
+            group['_id'] = 'group:' + group['children'][-1]
+
+    if group:
+        yield group
+
+
+def merge_spans(spans):
+    """Merges overlapping (low, high) spans."""
+    merged = []
+    for low, high in sorted(map(tuple, spans)):
+        if merged and low <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+
+def reset_source_state(source_data):
+    """Clears a source's incremental fetch state so that its next update fetches everything."""
+    source_data['since'] = {}
+    for key in ('manifest', 'head', 'first_added', 'seen', 'deferred'):
+        source_data.pop(key, None)
+    return source_data
+
+
+# Fields holding the raw fetched data of an event, which "strip_after"
+# retention drops once the event has been processed.
+STRIPPABLE_FIELDS = ('data', 'raw')
+
+# Fields of an event that its timeline entry is made from.
+TIMELINE_FIELDS = ('_id', 'source', 'kind', 'timestamp', 'collapse')
+
+
+def decode_dict(dict_):
+    """Accepts a dict of encoded items and returns a dict of decoded items."""
+    return dict((k, codec.decode(v)) for k, v in dict_.iteritems())
 
 
 class Store(object):
     def __init__(self, config=None):
         self.config = config or {}
+        self.batch_size = int(os.environ.get('BEEN_BATCH_SIZE', 500))
+        self.timeline_built = None
+
+    def store_events(self, events):
+        """Stores an iterable of events in batches of self.batch_size, returning
+        the number of events that were added or changed."""
+        changed = 0
+        for batch in batches(events, self.batch_size):
+            changed += len(self.write_batch(batch))
+        return changed
+
+    def write_batch(self, batch):
+        """Stores a batch of events and indexes those that changed for search."""
+        changed = self.store_batch(batch)
+        if changed:
+            self.write_search([(event['_id'], search.event_terms(event)) for event in changed])
+        return changed
+
+    def rebuild_search(self):
+        """Reindexes every stored event for search."""
+        for page, cursor in self.event_pages():
+            self.write_search([(event['_id'], search.event_terms(event)) for event in page])
+
+    def search(self, query, count=20, source=None, kind=None, after=None, before=None):
+        """Returns up to `count` (score, event) pairs for the events whose
+        summary, title, content or metadata contain every word of `query`,
+        best match first, optionally only those of one source or kind or
+        within a time range."""
+        terms = search.query_terms(query)
+        if not terms:
+            return []
+        results = []
+        for chunk in batches(self.search_ids(terms, source), max(count, 100)):
+            scores = dict((_id, score) for score, _id in chunk)
+            for event in self.events_by_ids([_id for score, _id in chunk]):
+                if (event is None or (source is not None and event['source'] != source) or
+                        (kind is not None and event.get('kind') != kind) or
+                        (after is not None and event['timestamp'] < after) or
+                        (before is not None and event['timestamp'] > before)):
+                    continue
+                results.append((scores[event['_id']], event))
+                if len(results) == count:
+                    return results
+        return results
+
+    def events_page(self, count=100, cursor=None, source=None, after=None, before=None):
+        """Returns a page of events, newest first, and the cursor of the next
+        page (or None after the last page). Events are ordered by timestamp
+        and then by id, so pages never skip or repeat events that share a
+        timestamp. `after` and `before` bound the timestamps (inclusive)."""
+        position = decode_cursor(cursor) if cursor else None
+        events = self.event_range(count, position, source, after, before)
+        next_cursor = None
+        if len(events) == count:
+            next_cursor = encode_cursor(events[-1]['timestamp'], events[-1]['_id'])
+        return events, next_cursor
+
+    def event_pages(self, source=None, after=None, before=None, page_size=None, cursor=None):
+        """Yields (events, cursor) pages of all events, newest first. Passing
+        a yielded cursor back resumes after its page."""
+        page_size = page_size or self.batch_size
+        while True:
+            page, next_cursor = self.events_page(page_size, cursor, source, after, before)
+            if page:
+                yield page, encode_cursor(page[-1]['timestamp'], page[-1]['_id'])
+            if not next_cursor:
+                return
+            cursor = next_cursor
+
+    def histogram_filter(self, source=None, kind=None):
+        if source is not None and kind is not None:
+            raise ValueError('histograms can be filtered by source or kind, not both')
+        if source is not None:
+            return 'source:' + source
+        if kind is not None:
+            return 'kind:' + kind
+
+    def histogram(self, period='day', source=None, kind=None):
+        """Returns (bucket, count) pairs of events per `period` (day, week or
+        month), oldest first."""
+        raise NotImplementedError
+
+    def rollups(self):
+        """Returns the stored rollup counters, keyed as by rollup_keys()."""
+        raise NotImplementedError
+
+    def replace_rollups(self, counts):
+        """Replaces the stored rollup counters with `counts`."""
+        raise NotImplementedError
+
+    def compute_rollups(self):
+        """Counts the rollups of all stored events from scratch."""
+        counts = defaultdict(int)
+        for page, cursor in self.event_pages():
+            for event in page:
+                for key in event_rollup_keys(event):
+                    counts[key] += 1
+        return counts
+
+    def rebuild_rollups(self):
+        """Recomputes the rollup counters from the stored events. Returns the
+        number of counters that were wrong."""
+        counts = self.compute_rollups()
+        current = self.rollups()
+        self.replace_rollups(counts)
+        return sum(1 for key in set(counts) | set(current)
+                   if counts.get(key, 0) != current.get(key, 0))
+
+    def store_update(self, source, events):
+        def tag_events():
+            for event in events:
+                event['kind'] = source.kind
+                event['source'] = source.source_id
+                stats.count('events')
+                yield event
 
-    def collapsed_events(self, *args, **kwargs):
-        groups = {}
+        # Store the source after its events, since sources that fetch lazily
+        # only update their fetch state once the events have been consumed.
+        # Only the timeline fields of changed events are kept until then.
+        changed = []
+        for batch in batches(tag_events(), self.batch_size):
+            with stats.phase('store'):
+                changed.extend(dict((key, event[key]) for key in TIMELINE_FIELDS if key in event)
+                               for event in self.write_batch(batch))
+        with stats.phase('store'):
+            self.store_source(source)
+            if source.removed:
+                self.remove_events(source.removed)
+            if self.check_timeline():
+                self.update_timeline(source.source_id, source.config, changed, source.removed)
+            else:
+                self.rebuild_timeline()
+        stats.count('changed', len(changed))
+        return len(changed)
+
+    def timeline_entry_ids(self, event_ids):
+        """Returns the ids of the timeline entries holding any of `event_ids`."""
+        raise NotImplementedError
+
+    def timeline_entries(self, ids):
+        """Returns the stored timeline entries with the given ids, skipping
+        those that do not exist."""
+        raise NotImplementedError
+
+    def timeline_groups(self, source_id, low, high):
+        """Returns the groups of a source that may overlap the (low, high)
+        span: those whose newest event is within it, and the first one newer.
+        Groups of a source never overlap, so only that one may extend into
+        the span."""
+        raise NotImplementedError
+
+    def timeline_page(self, count, position=None):
+        """Returns up to `count` timeline entries, newest first, after the
+        (timestamp, id) `position` of the previous page if given."""
+        raise NotImplementedError
+
+    def write_timeline(self, entries, deleted):
+        """Stores timeline entries and deletes the `deleted` ones."""
+        raise NotImplementedError
+
+    def clear_timeline(self):
+        raise NotImplementedError
+
+    def update_timeline(self, source_id, config, changed, removed=()):
+        """Updates the timeline entries of a source after `changed` events
+        were stored and the events with ids in `removed` were removed.
+
+        Only the stretches of the source's timeline around the changed
+        events (and the groups that previously held them) are regrouped."""
+        removed = list(removed)
+        if not changed and not removed:
+            return
+        old = dict((entry['_id'], entry) for entry in self.timeline_entries(
+            self.timeline_entry_ids([event['_id'] for event in changed] + removed)))
+
+        entries = []
+        spans = []
+        for event in changed:
+            interval = collapse_interval(config, event)
+            if interval is None:
+                entries.extend(timeline_entries(config, [event]))
+            else:
+                spans.append((event['timestamp'] - interval, event['timestamp'] + interval))
+        spans.extend((entry['oldest'], entry['timestamp']) for entry in old.itervalues() if is_group(entry))
+
+        # Widen the spans to cover the groups they overlap, until they cover
+        # whole groups.
+        spans = merge_spans(spans)
+        while True:
+            for low, high in spans:
+                old.update((group['_id'], group) for group in self.timeline_groups(source_id, low, high)
+                           if group['oldest'] <= high)
+            widened = merge_spans(spans + [(entry['oldest'], entry['timestamp'])
+                                           for entry in old.itervalues() if is_group(entry)])
+            if widened == spans:
+                break
+            spans = widened
+
+        for low, high in spans:
+            events = (event for page, cursor in self.event_pages(source=source_id, after=low, before=high)
+                      for event in page)
+            entries.extend(timeline_entries(config, events))
+
+        ids = set(entry['_id'] for entry in entries)
+        self.write_timeline(entries, [entry for _id, entry in old.iteritems() if _id not in ids])
+
+    def rebuild_timeline(self):
+        """Regroups the timeline of every source from scratch."""
+        self.clear_timeline()
         sources = self.get_sources()
-        events = list(self.events(*args, **kwargs))
-        for index, event in enumerate(events):
-            source = event['source']
-            collapse = sources[source].get('collapse', False)
-            if collapse == True: collapse = {}
-
-            # Group if the source or the event has a "collapse" property set.
-            if collapse != False or event.get('collapse'):
-                def group_event():
-                    if source not in groups:
-                        groups[source] = {
-                            "source": source,
-                            "kind": event["kind"],
-                            "timestamp": event["timestamp"],
-                            "index": index,
-                            "children": [],
-                        }
-                    group = groups[source]
-
-                    # Group if the event occured within "interval" (default 2 hours) of
-                    # the last of the same source.
-                    latest = group['timestamp'] if group["children"] else event['timestamp']
-                    interval = collapse.get('interval', 2*60*60)
-                    # Compare latest - current, since events are ordered descending by timestamp.
-                    if group['timestamp'] - event['timestamp'] <= interval:
-                        event["collapsed"] = True
-                        group["children"].append(event)
-                    else:
-                        # If a longer interval occurred, empty the group and add it at the position of its last event.
-                        events[group["index"]] = group
-                        del group["index"]
-                        del groups[source]
-                        # Add this event to a new group by processing it again (with the cleared group).
-                        group_event()
-                group_event()
+        for source_id in self.events_by_source_count():
+            events = (event for page, cursor in self.event_pages(source=source_id) for event in page)
+            for entries in batches(timeline_entries(sources.get(source_id, {}), events), self.batch_size):
+                self.write_timeline(entries, [])
+        self.store_state('timeline_built', True)
+        self.timeline_built = True
+
+    def check_timeline(self):
+        """Returns whether the timeline has been built. Archives written
+        before it was maintained have none until rebuild_timeline() runs."""
+        if not self.timeline_built:
+            self.timeline_built = self.get_state('timeline_built', False)
+        return self.timeline_built
+
+    def timeline(self, count=100, cursor=None):
+        """Returns a page of the collapsed timeline, newest first, and the
+        cursor of the next page (or None after the last page). Events of
+        sources (or events) with a "collapse" setting are grouped into
+        {source, kind, timestamp, oldest, children} dicts."""
+        if not self.check_timeline():
+            self.rebuild_timeline()
+        entries = self.timeline_page(count, decode_cursor(cursor) if cursor else None)
+        ids = [_id for entry in entries for _id in entry['children']]
+        events = dict((event['_id'], event) for event in self.events_by_ids(ids) if event)
+
+        items = []
+        for entry in entries:
+            children = [events[_id] for _id in entry['children'] if _id in events]
+            if not is_group(entry):
+                items.extend(children)
+            elif children:
+                items.append(dict(entry, children=children))
 
-        return filter(lambda e:not e.get("collapsed"), events)
+        next_cursor = None
+        if len(entries) == count:
+            next_cursor = encode_cursor(entries[-1]['timestamp'], entries[-1]['_id'])
+        return items, next_cursor
+
+    def collapsed_events(self, count=100, before=None, cursor=None):
+        if cursor is None and before is not None:
+            cursor = encode_cursor(before, u'\uffff')
+        return self.timeline(count, cursor)[0]
+
+    def event_size(self, event):
+        """Returns roughly how many bytes an event takes up in the store."""
+        return len(json.dumps(event, separators=(',', ':'), default=unicode))
+
+    def compact(self, now=None):
+        """Applies the "retention" setting of each source: its events older
+        than "max_age" days, or beyond its newest "max_count", are removed,
+        and the raw data of events older than "strip_after" days is dropped.
+        Events are removed and rewritten in batches, so indexes, rollups, the
+        timeline and search stay consistent.
+
+        Returns the number of events removed and stripped, and the number of
+        bytes of events reclaimed."""
+        now = now or time.time()
+        totals = [0, 0, 0]
+        for source_id, config in self.get_sources().iteritems():
+            retention = config.get('retention') or {}
+            for n, count in enumerate(self.compact_source(source_id, config, retention, now)):
+                totals[n] += count
+        if totals[0] or totals[1]:
+            self.compact_storage()
+        return tuple(totals)
+
+    def compact_source(self, source_id, config, retention, now):
+        max_age, max_count, strip_after = (retention.get(key) for key in ('max_age', 'max_count', 'strip_after'))
+        remove_before = now - max_age * 86400 if max_age is not None else None
+        strip_before = now - strip_after * 86400 if strip_after is not None else None
+        cutoffs = [cutoff for cutoff in (remove_before, strip_before) if cutoff is not None]
+        if max_count is None and not cutoffs:
+            return 0, 0, 0
+
+        # Without a count limit, events newer than every cutoff are kept whole.
+        before = max(cutoffs) if max_count is None else None
+        events = (event for page, cursor in self.event_pages(source=source_id, before=before) for event in page)
+        removed, stripped, reclaimed = 0, 0, 0
+        for batch in batches(enumerate(events), self.batch_size):
+            remove, strip = [], []
+            for n, event in batch:
+                if ((max_count is not None and n >= max_count) or
+                        (remove_before is not None and event['timestamp'] < remove_before)):
+                    remove.append(event['_id'])
+                    reclaimed += self.event_size(event)
+                elif (strip_before is not None and event['timestamp'] < strip_before and
+                        any(field in event for field in STRIPPABLE_FIELDS)):
+                    size = self.event_size(event)
+                    for field in STRIPPABLE_FIELDS:
+                        event.pop(field, None)
+                    # Stripped events can no longer be reprocessed.
+                    event['stripped'] = True
+                    strip.append(event)
+                    reclaimed += size - self.event_size(event)
+            if remove:
+                self.remove_events(remove)
+            changed = self.write_batch(strip) if strip else []
+            self.update_timeline(source_id, config, changed, remove)
+            removed += len(remove)
+            stripped += len(changed)
+        return removed, stripped, reclaimed
+
+    def compact_storage(self):
+        """Returns the space freed by compaction to the system, where the
+        backend does not do so by itself."""
+        pass
+
+
+# Emits the keys of event_rollup_keys() for each event.
+COUCH_ROLLUPS_MAP = """
+function(doc) {
+    if (doc.type != 'event') { return; }
+    function pad(n) { return (n < 10 ? '0' : '') + n; }
+    var date = new Date(doc.timestamp * 1000);
+    var day = date.toISOString().slice(0, 10);
+    // The ISO week is that of the week's Thursday.
+    var thursday = new Date(Date.UTC(date.getUTCFullYear(), date.getUTCMonth(),
+                                     date.getUTCDate() + 4 - (date.getUTCDay() || 7)));
+    var week = Math.ceil(((thursday - Date.UTC(thursday.getUTCFullYear(), 0, 1)) / 86400000 + 1) / 7);
+    var buckets = {day: day, week: thursday.getUTCFullYear() + '-W' + pad(week), month: day.slice(0, 7)};
+    var kind = doc.kind || '';
+    emit(['source', doc.source], null);
+    emit(['kind', kind], null);
+    for (var period in buckets) {
+        emit([period, null, buckets[period]], null);
+        emit([period, 'source:' + doc.source, buckets[period]], null);
+        emit([period, 'kind:' + kind, buckets[period]], null);
+    }
+}
+"""
 
 
 class CouchStore(Store):
@@ -80,6 +520,7 @@ class CouchStore(Store):
             os.environ.get("BEEN_COUCHDB_HOST", "localhost"),
             os.environ.get("BEEN_COUCHDB_PORT", 5984),
         )
+        import couchdb
         self.server = couchdb.client.Server(url=url)
 
         db_name = self.config.get('db_name', 'activity')
@@ -103,15 +544,36 @@ class CouchStore(Store):
                     "map": "function(doc) { if (doc.type == 'event') { emit([doc.source, doc.timestamp], doc) } }",
                 },
                 "events-by-source-count": {
-                    "map": "function(doc) { if (doc.type == 'event') { emit(doc.source, doc) } }",
+                    "map": "function(doc) { if (doc.type == 'event') { emit(doc.source, null) } }",
+                    "reduce": "_count",
+                },
+                "rollups": {
+                    "map": COUCH_ROLLUPS_MAP,
                     "reduce": "_count",
                 },
+                "timeline": {
+                    "map": "function(doc) { if (doc.type == 'timeline') { emit([doc.timestamp, doc._id], doc) } }",
+                },
+                "search": {
+                    "map": "function(doc) { if (doc.type == 'search') { for (var term in doc.terms) { emit(term, doc.terms[term]) } } }",
+                },
+                "timeline-by-child": {
+                    "map": "function(doc) { if (doc.type == 'timeline') { doc.children.forEach(function(child) { emit(child, null) }) } }",
+                },
+                "timeline-groups": {
+                    "map": "function(doc) { if (doc.type == 'timeline' && doc._id != 'timeline:' + doc.children[0]) { emit([doc.source, doc.timestamp], doc) } }",
+                },
                 "events-by-slug": {
                     "map": "function(doc) { if (doc.type == 'event' && doc.slug) { emit(doc.slug, doc) } }",
                 },
             }
         }
+        # Rewriting the design document makes CouchDB rebuild its views, so
+        # it is only written when the views above change.
+        views['version'] = sha1(json.dumps(views, sort_keys=True)).hexdigest()
         doc = self.db.get(views['_id'], {})
+        if doc.get('version') == views['version']:
+            return
         doc.update(views)
         self.db[views['_id']] = doc
 
@@ -120,47 +582,62 @@ class CouchStore(Store):
 
     def store_source(self, source):
         source_data = source.config.copy()
+        source_data['_id'] = source.source_id
         source_data['type'] = 'source'
         dates_to_epoch(source_data)
-        if source.source_id not in self.db or self.db[source.source_id] != source_data:
-            self.db[source.source_id] = dates_to_epoch(source_data)
+        stored = self.db.get(source.source_id)
+        if stored is not None:
+            # Configs copied from elsewhere carry no (or another) revision.
+            source_data['_rev'] = stored['_rev']
+        if stored != source_data:
+            self.db[source.source_id] = source_data
+            # couchdb records the new revision in the copy that was saved;
+            # the next save of this source must send it.
+            source.config['_rev'] = source_data['_rev']
 
-    def store_events(self, events):
+    def store_batch(self, events):
         ids = {}
-        changed = 0
-        for event in events:
-            dates_to_epoch(event)
-            event.setdefault('_id', sha1(event['summary'].encode('utf-8')+str(event['timestamp'])).hexdigest())
-            ids[event['_id']] = event
-            event['type'] = 'event'
+        changed = []
+        # The documents themselves are encoded by couchdb as they are sent.
+        with stats.phase('serialize'):
+            for event in events:
+                prepare_event(event)
+                event['type'] = 'event'
+                fingerprint = event_fingerprint(event)
+                if '_rev' in event and event.get('fingerprint') == fingerprint:
+                    # A stored event (e.g. being reprocessed) that did not change.
+                    continue
+                event['fingerprint'] = fingerprint
+                ids[event['_id']] = event
 
         tries = 3
         while ids and tries:
             tries -= 1
-            result = self.db.update(ids.values())
-            for success, _id, info in result:
+            conflicts = []
+            for success, _id, info in self.db.update(ids.values()):
                 if success:
-                    del ids[_id]
-                    changed += 1
+                    changed.append(ids.pop(_id))
                 else:
-                    cur = self.db[_id]
-                    ids[_id]['_rev'] = cur['_rev']
-                    if cur == ids[_id]:
+                    conflicts.append(_id)
+
+            # Fetch the current revisions of all conflicting events at once.
+            if conflicts:
+                for row in self.db.view('_all_docs', keys=conflicts, include_docs=True):
+                    if row.doc is None:
+                        continue
+                    event = ids[row.id]
+                    if row.doc.get('fingerprint') == event['fingerprint']:
                         # If the data is the same, skip creating a new revision.
-                        del ids[_id]
+                        del ids[row.id]
+                    else:
+                        event['_rev'] = row.doc['_rev']
 
         if ids:
+            import couchdb
             raise couchdb.ResourceConflict
 
         return changed
 
-    def store_update(self, source, events):
-        for event in events:
-            event['kind'] = source.kind
-            event['source'] = source.source_id
-        self.store_source(source)
-        return self.store_events(events)
-
     def events(self, count=100, before=None, source=None, descending=True):
         options = { 'descending': descending }
         if count is not None:
@@ -181,33 +658,230 @@ class CouchStore(Store):
 
         return (event.value for event in self.db.view(view, **options))
 
+    def event_range(self, count, position=None, source=None, after=None, before=None):
+        # Rows with equal keys are ordered by document id.
+        view, key = 'activity/events', lambda timestamp: timestamp
+        options = {'descending': True, 'limit': count}
+        if source is not None:
+            view, key = 'activity/events-by-source', lambda timestamp: [source, timestamp]
+            options['startkey'], options['endkey'] = [source, {}], [source]
+        if before is not None:
+            options['startkey'] = key(before)
+        if after is not None:
+            options['endkey'] = key(after)
+        if position is not None:
+            timestamp, last = position
+            options['startkey'], options['startkey_docid'] = key(timestamp), last
+            # Skip the event at the cursor itself, if it still exists.
+            options['limit'] += 1
+        rows = self.db.view(view, **options)
+        return [row.value for row in rows if position is None or row.id != position[1]][:count]
+
+    def get_state(self, key, default=None):
+        doc = self.db.get('state:' + key)
+        return doc['value'] if doc else default
+
+    def store_state(self, key, value):
+        doc = self.db.get('state:' + key, {'_id': 'state:' + key, 'type': 'state'})
+        doc['value'] = value
+        self.db.save(doc)
+
+    def remove_events(self, ids):
+        ids = list(ids)
+        docs = []
+        # Also delete the events' search postings.
+        for row in self.db.view('_all_docs', keys=ids + ['search:' + _id for _id in ids]):
+            if row.get('value') and not row.value.get('deleted'):
+                docs.append({'_id': row.id, '_rev': row.value['rev'], '_deleted': True})
+        self.db.update(docs)
+
+    def events_by_ids(self, ids):
+        return [row.doc for row in self.db.view('_all_docs', keys=list(ids), include_docs=True)]
+
+    def write_search(self, entries):
+        docs = dict(('search:' + _id, {'_id': 'search:' + _id, 'type': 'search', 'terms': terms})
+                    for _id, terms in entries)
+        for row in self.db.view('_all_docs', keys=docs.keys(), include_docs=True):
+            if row.doc:
+                docs[row.id]['_rev'] = row.doc['_rev']
+        self.db.update(docs.values())
+
+    def search_ids(self, terms, source=None):
+        postings = dict((term, {}) for term in terms)
+        for row in self.db.view('activity/search', keys=terms):
+            postings[row.key][row.id[len('search:'):]] = row.value
+        return search.rank(postings, sum(self.events_by_source_count().itervalues()))
+
+    def clear_search(self):
+        docs = [{'_id': row.id, '_rev': row.value['rev'], '_deleted': True}
+                for row in self.db.view('_all_docs', startkey='search:', endkey=u'search:\ufff0')]
+        for batch in batches(docs, self.batch_size):
+            self.db.update(batch)
+
     def events_by_slug(self, slug):
         return (event.value for event in self.db.view('activity/events-by-slug')[slug])
 
+    def timeline_doc(self, entry):
+        return dict(entry, _id='timeline:' + entry['_id'], type='timeline')
+
+    def timeline_entry(self, doc):
+        entry = dict((k, v) for k, v in doc.iteritems() if k not in ('_rev', 'type'))
+        entry['_id'] = doc['_id'][len('timeline:'):]
+        return entry
+
+    def timeline_entry_ids(self, event_ids):
+        if not event_ids:
+            return []
+        return set(row.id[len('timeline:'):] for row in self.db.view('activity/timeline-by-child', keys=event_ids))
+
+    def timeline_entries(self, ids):
+        ids = ['timeline:' + _id for _id in ids]
+        if not ids:
+            return []
+        return [self.timeline_entry(row.doc) for row in self.db.view('_all_docs', keys=ids, include_docs=True) if row.doc]
+
+    def timeline_groups(self, source_id, low, high):
+        rows = list(self.db.view('activity/timeline-groups', startkey=[source_id, low], endkey=[source_id, high]))
+        rows += list(self.db.view('activity/timeline-groups', startkey=[source_id, high], endkey=[source_id, {}], limit=len(rows) + 1))
+        return dict((row.id, self.timeline_entry(row.value)) for row in rows).values()
+
+    def timeline_page(self, count, position=None):
+        options = {'descending': True, 'limit': count}
+        if position is not None:
+            timestamp, last = position
+            # Skip the entry at the cursor itself, if it still exists.
+            options['startkey'] = [timestamp, 'timeline:' + last]
+            options['limit'] += 1
+        rows = self.db.view('activity/timeline', **options)
+        return [self.timeline_entry(row.value) for row in rows
+                if position is None or row.key != options['startkey']][:count]
+
+    def write_timeline(self, entries, deleted):
+        docs = dict((doc['_id'], doc) for doc in map(self.timeline_doc, entries))
+        for entry in deleted:
+            docs.setdefault('timeline:' + entry['_id'], {'_id': 'timeline:' + entry['_id'], '_deleted': True})
+
+        for row in self.db.view('_all_docs', keys=docs.keys(), include_docs=True):
+            if not row.doc:
+                continue
+            doc = docs[row.id]
+            if not doc.get('_deleted') and self.timeline_entry(row.doc) == self.timeline_entry(doc):
+                del docs[row.id]
+            else:
+                doc['_rev'] = row.doc['_rev']
+        docs = [doc for doc in docs.itervalues() if '_rev' in doc or not doc.get('_deleted')]
+        for batch in batches(docs, self.batch_size):
+            self.db.update(batch)
+
+    def clear_timeline(self):
+        docs = [{'_id': row.id, '_rev': row.value['_rev'], '_deleted': True}
+                for row in self.db.view('activity/timeline')]
+        for batch in batches(docs, self.batch_size):
+            self.db.update(batch)
+
     def events_by_source_count(self):
         return dict((count.key, count.value) for count in self.db.view('activity/events-by-source-count', group_level=1))
 
+    def histogram(self, period='day', source=None, kind=None):
+        filter = self.histogram_filter(source, kind)
+        rows = self.db.view('activity/rollups', group_level=3,
+                            startkey=[period, filter], endkey=[period, filter, {}])
+        return [(row.key[2], row.value) for row in rows]
+
+    def rollups(self):
+        return dict((tuple(row.key), row.value) for row in self.db.view('activity/rollups', group=True))
+
+    def replace_rollups(self, counts):
+        # CouchDB maintains the rollups view by itself.
+        pass
+
+    def compact_storage(self):
+        # Deleted and superseded revisions are only dropped by compaction.
+        self.db.compact()
+        self.db.cleanup()
+
     def empty(self):
         for event in self.db.view('activity/events'):
             self.db.delete(event.value)
+        self.clear_timeline()
+        self.clear_search()
 
         for row in self.db.view('activity/sources'):
-            source = row.value
-            source['since'] = {}
-            self.db[row.id] = source
+            self.db[row.id] = reset_source_state(row.value)
 
 
 class RedisStore(Store):
+    # Writes a batch of events in one round trip, skipping events whose
+    # index record is unchanged. ARGV is the key prefix followed by (id,
+    # record, payload, timestamp, source, slug) for each event, where the
+    # record is the event's fingerprint, source, kind, day, week and month,
+    # tab separated. The rollup counters of the previous record (if any) are
+    # decremented and those of the new one incremented. Returns the ids of
+    # the events written.
+    store_script = """
+        local prefix = ARGV[1]
+        local changed = {}
+
+        local function count(record, delta)
+            local fields = {}
+            for field in string.gmatch(record, '([^\t]*)\t?') do
+                table.insert(fields, field)
+            end
+            if #fields < 6 then
+                -- Recorded before rollups existed, so not counted.
+                return
+            end
+            local source, kind = fields[2], fields[3]
+            redis.call('HINCRBY', prefix .. 'rollup:source', source, delta)
+            redis.call('HINCRBY', prefix .. 'rollup:kind', kind, delta)
+            local periods = {'day', 'week', 'month'}
+            for p = 1, 3 do
+                local key, bucket = prefix .. 'rollup:' .. periods[p], fields[3 + p]
+                redis.call('HINCRBY', key, bucket, delta)
+                redis.call('HINCRBY', key .. ':source:' .. source, bucket, delta)
+                redis.call('HINCRBY', key .. ':kind:' .. kind, bucket, delta)
+            end
+        end
+
+        for i = 2, #ARGV, 6 do
+            local id, record, payload = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+            local timestamp, source, slug = ARGV[i + 3], ARGV[i + 4], ARGV[i + 5]
+            local previous = redis.call('HGET', prefix .. 'events-fingerprint', id)
+            if previous ~= record then
+                if previous then
+                    count(previous, -1)
+                end
+                count(record, 1)
+                redis.call('HSET', prefix .. 'events', id, payload)
+                redis.call('HSET', prefix .. 'events-fingerprint', id, record)
+                redis.call('ZADD', prefix .. 'events-by-timestamp', timestamp, id)
+                redis.call('ZADD', prefix .. 'events-by-source:' .. source, timestamp, id)
+                if slug ~= '' then
+                    redis.call('HSET', prefix .. 'events-by-slug', slug, id)
+                end
+                table.insert(changed, id)
+            end
+        end
+        return changed
+    """
+
     def __init__(self):
         super(RedisStore, self).__init__()
+        import redis
         self.db = redis.Redis(
             host=os.environ.get("BEEN_REDIS_HOST", "localhost"),
-            port=os.envrion.get("BEEN_REDIS_PORT", 6379),
+            port=os.environ.get("BEEN_REDIS_PORT", 6379),
         )
         self.prefix = 'activity-'
+        self.codec = codec.Codec.from_spec(
+            os.environ.get('BEEN_REDIS_CODEC', 'json+zlib'),
+            threshold=int(os.environ.get('BEEN_REDIS_COMPRESS_THRESHOLD', 1024)),
+        )
+        self.store_events_script = self.db.register_script(self.store_script)
+        self.rollups_built = None
 
     def get_sources(self):
-        return unpickle_dict(self.db.hgetall(self.prefix + 'sources'))
+        return decode_dict(self.db.hgetall(self.prefix + 'sources'))
 
     def get_source_ids(self):
         return self.db.hkeys(self.prefix + 'sources')
@@ -215,31 +889,59 @@ class RedisStore(Store):
     def store_source(self, source):
         source_data = source.config.copy()
         dates_to_epoch(source_data)
-        self.db.hset(self.prefix + 'sources', source.source_id, pickle.dumps(source_data))
+        self.db.hset(self.prefix + 'sources', source.source_id, self.codec.encode(source_data))
 
-    def store_events(self, events):
+    def store_batch(self, events):
         ids = {}
-        for event in events:
-            dates_to_epoch(event)
-            event.setdefault('_id', sha1(event['summary'].encode('utf-8')+str(event['timestamp'])).hexdigest())
-
-            pipe = self.db.pipeline(transaction=True)
-            pipe.hset(self.prefix + 'events', event['_id'], pickle.dumps(event))
-            # Uggghhhh, the zadd API is terrible!
-            pipe.zadd(self.prefix + 'events-by-timestamp', **{event['_id']: event['timestamp']})
-            pipe.zadd(self.prefix + 'events-by-source:' + event['source'], **{event['_id']: event['timestamp']})
-            if event.get('slug'):
-                pipe.hset(self.prefix + 'events-by-slug', event['slug'], event['_id'])
-            pipe.execute()
+        args = [self.prefix]
+        with stats.phase('serialize'):
+            for event in events:
+                prepare_event(event)
+                ids[event['_id']] = event
+                args.extend([
+                    event['_id'],
+                    self.index_record(event),
+                    self.codec.encode(event),
+                    event['timestamp'],
+                    event['source'],
+                    event.get('slug') or '',
+                ])
+                stats.count('stored_bytes', len(args[-4]))
 
-        return len(events)
+        if not ids:
+            return []
+        self.check_rollups()
+        return [ids[_id] for _id in self.store_events_script(args=args)]
 
-    def store_update(self, source, events):
-        for event in events:
-            event['kind'] = source.kind
-            event['source'] = source.source_id
-        self.store_source(source)
-        return self.store_events(events)
+    def index_record(self, event):
+        buckets = time_buckets(event['timestamp'])
+        return u'\t'.join([event_fingerprint(event), event['source'], event.get('kind', '')] +
+                           [buckets[period] for period in PERIODS])
+
+    def record_rollup_keys(self, record):
+        fields = record.decode('utf-8').split(u'\t')
+        if len(fields) < 6:
+            return []
+        return rollup_keys(fields[1], fields[2], dict(zip(PERIODS, fields[3:6])))
+
+    def check_rollups(self):
+        """Returns whether the rollup counters include every stored event.
+        Events stored before the counters existed aren't counted until
+        rebuild_rollups() has run, except in archives that started empty."""
+        if self.rollups_built is None:
+            built = self.get_state('rollups_built', False)
+            if not built and not self.db.exists(self.prefix + 'events'):
+                self.store_state('rollups_built', True)
+                built = True
+            self.rollups_built = built
+        return self.rollups_built
+
+    def rollup_hash(self, key):
+        """Maps a rollup key to the Redis hash and field holding its counter."""
+        if len(key) == 2:
+            return self.prefix + 'rollup:' + key[0], key[1]
+        period, filter, bucket = key
+        return self.prefix + 'rollup:' + period + (':' + filter if filter else ''), bucket
 
     def events(self, count=100, before=None, source=None, descending=True):
         key = self.prefix + 'events-by-timestamp'
@@ -247,47 +949,730 @@ class RedisStore(Store):
 
         if source is not None:
             key = self.prefix + 'events-by-source:' + source
-        elif before is not None:
+        if before is not None:
             start = int(before)
 
         query = self.db.zrevrangebyscore if descending else self.db.zrangebyscore
 
         return self.events_by_ids(query(key, start, '-inf', start=0, num=count))
 
+    def zset_page(self, key, count, position=None, low='-inf', high='+inf'):
+        """Returns the ids of a page of a sorted set, highest scores first.
+        Members with equal scores are ordered by id, descending. Pages after
+        a (score, id) position cost the same as the first page."""
+        if position is None:
+            return self.db.zrevrangebyscore(key, high, low, start=0, num=count)
+
+        score, last = position
+        rank = self.db.zrevrank(key, last)
+        if rank is not None and self.db.zscore(key, last) == score:
+            members = self.db.zrevrange(key, rank + 1, rank + count, withscores=True)
+        else:
+            # The member at the position was removed; resume after where it was.
+            ties = self.db.zcount(key, score, score)
+            members = [(_id, member_score) for _id, member_score in self.db.zrevrangebyscore(
+                           key, score, low, start=0, num=count + ties, withscores=True)
+                       if member_score < score or _id < last][:count]
+        return [_id for _id, member_score in members if low == '-inf' or member_score >= low]
+
+    def event_range(self, count, position=None, source=None, after=None, before=None):
+        key = self.prefix + ('events-by-source:' + source if source is not None else 'events-by-timestamp')
+        ids = self.zset_page(key, count, position,
+                             low=after if after is not None else '-inf',
+                             high=before if before is not None else '+inf')
+        return list(self.events_by_ids(ids))
+
+    def get_state(self, key, default=None):
+        value = self.db.hget(self.prefix + 'state', key)
+        return codec.decode(value) if value is not None else default
+
+    def store_state(self, key, value):
+        self.db.hset(self.prefix + 'state', key, self.codec.encode(value))
+
+    def remove_events(self, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        pipe = self.db.pipeline(transaction=True)
+        pipe.hmget(self.prefix + 'events', ids)
+        pipe.hmget(self.prefix + 'events-fingerprint', ids)
+        pipe.hmget(self.prefix + 'search-terms', ids)
+        payloads, records, search_terms = pipe.execute()
+        for _id, data, record, terms in zip(ids, payloads, records, search_terms):
+            if data is None:
+                continue
+            event = codec.decode(data)
+            for term in codec.decode(terms) if terms else []:
+                pipe.zrem(self.prefix + 'search:' + term, _id)
+            pipe.hdel(self.prefix + 'search-terms', _id)
+            for key in self.record_rollup_keys(record or ''):
+                pipe.hincrby(*self.rollup_hash(key), amount=-1)
+            pipe.hdel(self.prefix + 'events', _id)
+            pipe.hdel(self.prefix + 'events-fingerprint', _id)
+            pipe.zrem(self.prefix + 'events-by-timestamp', _id)
+            pipe.zrem(self.prefix + 'events-by-source:' + event['source'], _id)
+            if event.get('slug'):
+                pipe.hdel(self.prefix + 'events-by-slug', event['slug'])
+        pipe.execute()
+
     def event_by_id(self, id):
-        return pickle.loads(self.db.hget(self.prefix + 'events', id))
+        return codec.decode(self.db.hget(self.prefix + 'events', id))
+
+    def write_search(self, entries):
+        # Each term's postings are a sorted set of event ids scored by weight.
+        # The terms of each event are kept to remove it from them later.
+        ids = [_id for _id, terms in entries]
+        pipe = self.db.pipeline(transaction=True)
+        for (_id, terms), old_terms in zip(entries, self.db.hmget(self.prefix + 'search-terms', ids)):
+            for term in set(codec.decode(old_terms) if old_terms else []) - set(terms):
+                pipe.zrem(self.prefix + 'search:' + term, _id)
+            for term, weight in terms.iteritems():
+                pipe.zadd(self.prefix + 'search:' + term, **{_id: weight})
+            pipe.hset(self.prefix + 'search-terms', _id, self.codec.encode(sorted(terms)))
+        pipe.execute()
+
+    def search_ids(self, terms, source=None):
+        keys = [self.prefix + 'search:' + term for term in terms]
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hlen(self.prefix + 'events')
+        for key in keys:
+            pipe.zcard(key)
+        counts = pipe.execute()
+        total, frequencies = counts[0], counts[1:]
+        if not all(frequencies):
+            return []
+
+        weights = dict((key, search.idf(total, frequency)) for key, frequency in zip(keys, frequencies))
+        if source is not None:
+            weights[self.prefix + 'events-by-source:' + source] = 0
+        # The intersection is stored under a key of its own, so that it can
+        # be read a chunk at a time. Abandoned results expire.
+        result = self.prefix + 'search-result:' + os.urandom(8).encode('hex')
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zinterstore(result, weights)
+        pipe.expire(result, 300)
+        pipe.execute()
+        return self.search_result(result)
+
+    def search_result(self, key):
+        """Yields the (score, id) pairs of a stored search result, best
+        first, and deletes it once read."""
+        try:
+            start = 0
+            while True:
+                pipe = self.db.pipeline(transaction=False)
+                pipe.zrevrange(key, start, start + self.batch_size - 1, withscores=True)
+                pipe.expire(key, 300)
+                chunk = pipe.execute()[0]
+                for _id, score in chunk:
+                    yield score, _id
+                if len(chunk) < self.batch_size:
+                    return
+                start += self.batch_size
+        finally:
+            self.db.delete(key)
+
+    def search_keys(self):
+        return [self.prefix + 'search-terms'] + list(self.db.scan_iter(self.prefix + 'search:*', count=self.batch_size))
 
     def events_by_ids(self, ids):
         if not ids:
             return []
-        return (pickle.loads(p) for p in self.db.hmget(self.prefix + 'events', ids))
+        return (codec.decode(p) for p in self.db.hmget(self.prefix + 'events', ids))
 
     def events_by_slug(self, slug):
         id = self.db.hget(self.prefix + 'events-by-slug', slug)
         return [self.event_by_id(id)] if id is not None else []
 
     def events_by_source_count(self):
-        return dict((source_id, self.db.zcard(self.prefix + 'events-by-source:' + source_id)) for source_id in self.get_source_ids())
+        if not self.check_rollups():
+            return dict((source_id, self.db.zcard(self.prefix + 'events-by-source:' + source_id)) for source_id in self.get_source_ids())
+        return self.hash_counts(self.prefix + 'rollup:source')
+
+    def hash_counts(self, key):
+        return dict((field.decode('utf-8'), int(count))
+                    for field, count in self.db.hgetall(key).iteritems() if int(count))
+
+    def histogram(self, period='day', source=None, kind=None):
+        # Archives written before the rollups existed have them built first.
+        if not self.check_rollups():
+            self.rebuild_rollups()
+        key, _ = self.rollup_hash((period, self.histogram_filter(source, kind), None))
+        return sorted(self.hash_counts(key).iteritems())
+
+    def rollup_hashes(self):
+        return list(self.db.scan_iter(self.prefix + 'rollup:*', count=self.batch_size))
+
+    def rollups(self):
+        counts = {}
+        for key in self.rollup_hashes():
+            name = key.decode('utf-8')[len(self.prefix + 'rollup:'):]
+            dimension, _, filter = name.partition(':')
+            for field, count in self.hash_counts(key).iteritems():
+                if dimension in PERIODS:
+                    counts[dimension, filter or None, field] = count
+                else:
+                    counts[dimension, field] = count
+        return counts
+
+    def rebuild_rollups(self):
+        """Recomputes the rollup counters and index records of all events.
+        Returns the number of counters that were wrong."""
+        counts = defaultdict(int)
+        for batch in batches(self.db.hscan_iter(self.prefix + 'events', count=self.batch_size), self.batch_size):
+            records = {}
+            for _id, data in batch:
+                event = codec.decode(data)
+                records[_id] = self.index_record(event)
+                for key in event_rollup_keys(event):
+                    counts[key] += 1
+            self.db.hmset(self.prefix + 'events-fingerprint', records)
+
+        current = self.rollups()
+        wrong = sum(1 for key in set(counts) | set(current)
+                    if counts.get(key, 0) != current.get(key, 0))
+
+        hashes = defaultdict(dict)
+        for key, count in counts.iteritems():
+            name, field = self.rollup_hash(key)
+            hashes[name][field] = count
+        pipe = self.db.pipeline(transaction=True)
+        for name in self.rollup_hashes():
+            pipe.delete(name)
+        for name, fields in hashes.iteritems():
+            pipe.hmset(name, fields)
+        pipe.hset(self.prefix + 'state', 'rollups_built', self.codec.encode(True))
+        pipe.execute()
+        self.rollups_built = True
+        return wrong
+
+    def timeline_entry_ids(self, event_ids):
+        if not event_ids:
+            return []
+        return set(_id for _id in self.db.hmget(self.prefix + 'timeline-entry-of', event_ids) if _id)
+
+    def timeline_entries(self, ids):
+        ids = list(ids)
+        if not ids:
+            return []
+        return [codec.decode(data) for data in self.db.hmget(self.prefix + 'timeline', ids) if data]
+
+    def timeline_groups(self, source_id, low, high):
+        key = self.prefix + 'timeline-groups:' + source_id
+        pipe = self.db.pipeline(transaction=False)
+        pipe.zrangebyscore(key, low, high)
+        pipe.zrangebyscore(key, '({0}'.format(high), '+inf', start=0, num=1)
+        inside, after = pipe.execute()
+        return self.timeline_entries(inside + after)
+
+    def timeline_page(self, count, position=None):
+        return self.timeline_entries(self.zset_page(self.prefix + 'timeline-by-timestamp', count, position))
+
+    def write_timeline(self, entries, deleted):
+        pipe = self.db.pipeline(transaction=True)
+        for entry in deleted:
+            pipe.hdel(self.prefix + 'timeline', entry['_id'])
+            pipe.zrem(self.prefix + 'timeline-by-timestamp', entry['_id'])
+            pipe.zrem(self.prefix + 'timeline-groups:' + entry['source'], entry['_id'])
+            pipe.hdel(self.prefix + 'timeline-entry-of', *entry['children'])
+        for entry in entries:
+            pipe.hset(self.prefix + 'timeline', entry['_id'], self.codec.encode(entry))
+            pipe.zadd(self.prefix + 'timeline-by-timestamp', **{entry['_id']: entry['timestamp']})
+            if is_group(entry):
+                pipe.zadd(self.prefix + 'timeline-groups:' + entry['source'], **{entry['_id']: entry['timestamp']})
+            pipe.hmset(self.prefix + 'timeline-entry-of', dict.fromkeys(entry['children'], entry['_id']))
+        pipe.execute()
+
+    def timeline_keys(self):
+        return [self.prefix + 'timeline', self.prefix + 'timeline-by-timestamp', self.prefix + 'timeline-entry-of'] + \
+            list(self.db.scan_iter(self.prefix + 'timeline-groups:*', count=self.batch_size))
+
+    def clear_timeline(self):
+        self.db.delete(*self.timeline_keys())
+
+    def event_size(self, event):
+        return len(self.codec.encode(event))
+
+    def recode(self):
+        """Rewrites every stored value with the current codec, a batch at a
+        time. Returns the number of values rewritten."""
+        count = 0
+        for name in ('events', 'sources', 'state', 'timeline', 'search-terms'):
+            key = self.prefix + name
+            for batch in batches(self.db.hscan_iter(key, count=self.batch_size), self.batch_size):
+                self.db.hmset(key, dict((field, self.codec.encode(codec.decode(value)))
+                                        for field, value in batch))
+                count += len(batch)
+        return count
 
     def empty(self):
         pipe = self.db.pipeline(transaction=True)
         pipe.delete(
             self.prefix + 'events',
+            self.prefix + 'events-fingerprint',
             self.prefix + 'events-by-timestamp',
             self.prefix + 'events-by-slug',
-            *(self.prefix + 'events-by-source:' + source_id for source_id in self.get_source_ids())
+            *([self.prefix + 'events-by-source:' + source_id for source_id in self.get_source_ids()] +
+              self.rollup_hashes() + self.timeline_keys() + self.search_keys())
         )
+        pipe.hset(self.prefix + 'state', 'rollups_built', self.codec.encode(True))
         pipe.execute()
+        self.rollups_built = True
 
         sources = self.get_sources()
         if sources:
             for source_id in sources:
-                sources[source_id]['since'] = {}
-                sources[source_id] = pickle.dumps(sources[source_id])
+                sources[source_id] = self.codec.encode(reset_source_state(sources[source_id]))
             self.db.hmset(self.prefix + 'sources', sources)
 
 
+class SqliteStore(Store):
+    schema = """
+        CREATE TABLE IF NOT EXISTS sources (id TEXT PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS events (
+            id TEXT PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            source TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            slug TEXT,
+            day TEXT NOT NULL,
+            week TEXT NOT NULL,
+            month TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_by_timestamp ON events (timestamp, id);
+        CREATE INDEX IF NOT EXISTS events_by_source ON events (source, timestamp, id);
+        CREATE INDEX IF NOT EXISTS events_by_slug ON events (slug);
+        CREATE TABLE IF NOT EXISTS rollups (
+            dimension TEXT NOT NULL,
+            filter TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (dimension, filter, bucket)
+        );
+        CREATE TABLE IF NOT EXISTS timeline (
+            id TEXT PRIMARY KEY,
+            timestamp REAL NOT NULL,
+            source TEXT NOT NULL,
+            is_group INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS timeline_by_timestamp ON timeline (timestamp, id);
+        CREATE INDEX IF NOT EXISTS timeline_groups ON timeline (source, is_group, timestamp);
+        CREATE TABLE IF NOT EXISTS timeline_children (event_id TEXT PRIMARY KEY, entry_id TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS search (
+            term TEXT NOT NULL,
+            id TEXT NOT NULL,
+            weight REAL NOT NULL,
+            PRIMARY KEY (term, id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS search_by_id ON search (id);
+    """
+    # SQLite limits the number of parameters of a statement.
+    max_params = 500
+
+    def __init__(self, path=None):
+        super(SqliteStore, self).__init__()
+        path = path or os.environ.get(
+            'BEEN_SQLITE_PATH',
+            os.path.join(os.path.expanduser('~'), '.local', 'share', 'been', 'been.sqlite'),
+        )
+        if path != ':memory:' and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        # Connections may be handed between threads (e.g. reading ahead
+        # during migrations), though never used by two at once.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.schema)
+        self.codec = codec.Codec.from_spec(
+            os.environ.get('BEEN_SQLITE_CODEC', 'json+zlib'),
+            threshold=int(os.environ.get('BEEN_SQLITE_COMPRESS_THRESHOLD', 1024)),
+        )
+
+    def encode(self, value):
+        return buffer(self.codec.encode(value))
+
+    def decode(self, data):
+        return codec.decode(str(data))
+
+    def select_in(self, query, values):
+        """Runs a query with an "IN ({0})" clause for each slice of values
+        that fits in one statement, yielding the rows."""
+        for batch in batches(values, self.max_params):
+            for row in self.db.execute(query.format(','.join('?' * len(batch))), batch):
+                yield row
+
+    def get_sources(self):
+        return dict((_id, self.decode(data)) for _id, data in self.db.execute('SELECT id, data FROM sources'))
+
+    def store_source(self, source):
+        source_data = source.config.copy()
+        dates_to_epoch(source_data)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)',
+                            (source.source_id, self.encode(source_data)))
+
+    def add_rollups(self, counts):
+        # Totals per source and kind are stored with an empty filter.
+        rows = [(key[0], (key[1] if len(key) == 3 else None) or '', key[-1], count)
+                for key, count in counts.iteritems() if count]
+        self.db.executemany('INSERT OR IGNORE INTO rollups VALUES (?, ?, ?, 0)', [row[:3] for row in rows])
+        self.db.executemany('UPDATE rollups SET count = count + ? WHERE dimension = ? AND filter = ? AND bucket = ?',
+                            [row[3:] + row[:3] for row in rows])
+        self.db.execute('DELETE FROM rollups WHERE count = 0')
+
+    def store_batch(self, events):
+        batch = {}
+        for event in events:
+            prepare_event(event)
+            batch[event['_id']] = event
+
+        with self.db:
+            stored = dict((row[0], row[1:]) for row in self.select_in(
+                'SELECT id, fingerprint, source, kind, day, week, month FROM events WHERE id IN ({0})', batch.keys()))
+
+            changed, rows = [], []
+            counts = defaultdict(int)
+            with stats.phase('serialize'):
+                for _id, event in batch.iteritems():
+                    fingerprint = event_fingerprint(event)
+                    if _id in stored:
+                        old_fingerprint, source, kind, day, week, month = stored[_id]
+                        if old_fingerprint == fingerprint:
+                            continue
+                        for key in rollup_keys(source, kind, {'day': day, 'week': week, 'month': month}):
+                            counts[key] -= 1
+
+                    buckets = time_buckets(event['timestamp'])
+                    for key in rollup_keys(event['source'], event.get('kind', ''), buckets):
+                        counts[key] += 1
+                    rows.append((_id, event['timestamp'], event['source'], event.get('kind', ''),
+                                 event.get('slug') or None, buckets['day'], buckets['week'], buckets['month'],
+                                 fingerprint, self.encode(event)))
+                    stats.count('stored_bytes', len(rows[-1][-1]))
+                    changed.append(event)
+
+            self.db.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.add_rollups(counts)
+        return changed
+
+    def event_query(self, where, params, count):
+        query = 'SELECT data FROM events'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+        return [self.decode(data) for data, in self.db.execute(query, params + [count if count is not None else -1])]
+
+    def events(self, count=100, before=None, source=None, descending=True):
+        where, params = [], []
+        if source is not None:
+            where.append('source = ?')
+            params.append(source)
+        if before is not None:
+            where.append('timestamp <= ?')
+            params.append(before)
+        events = self.event_query(where, params, count)
+        return events if descending else events[::-1]
+
+    def event_range(self, count, position=None, source=None, after=None, before=None):
+        where, params = [], []
+        if source is not None:
+            where.append('source = ?')
+            params.append(source)
+        if after is not None:
+            where.append('timestamp >= ?')
+            params.append(after)
+        if before is not None:
+            where.append('timestamp <= ?')
+            params.append(before)
+        if position is not None:
+            # The first condition alone bounds the index scan.
+            where.append('timestamp <= ? AND (timestamp < ? OR id < ?)')
+            params.extend([position[0], position[0], position[1]])
+        return self.event_query(where, params, count)
+
+    def events_by_ids(self, ids):
+        events = dict((_id, self.decode(data)) for _id, data in
+                      self.select_in('SELECT id, data FROM events WHERE id IN ({0})', list(ids)))
+        return [events.get(_id) for _id in ids]
+
+    def events_by_slug(self, slug):
+        return [self.decode(data) for data, in self.db.execute('SELECT data FROM events WHERE slug = ?', (slug,))]
+
+    def events_by_source_count(self):
+        return dict(self.db.execute("SELECT bucket, count FROM rollups WHERE dimension = 'source'"))
+
+    def histogram(self, period='day', source=None, kind=None):
+        return list(self.db.execute(
+            'SELECT bucket, count FROM rollups WHERE dimension = ? AND filter = ? ORDER BY bucket',
+            (period, self.histogram_filter(source, kind) or '')))
+
+    def rollups(self):
+        counts = {}
+        for dimension, filter, bucket, count in self.db.execute('SELECT * FROM rollups'):
+            if dimension in PERIODS:
+                counts[dimension, filter or None, bucket] = count
+            else:
+                counts[dimension, bucket] = count
+        return counts
+
+    def replace_rollups(self, counts):
+        with self.db:
+            self.db.execute('DELETE FROM rollups')
+            self.add_rollups(counts)
+
+    def get_state(self, key, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return self.decode(row[0]) if row else default
+
+    def store_state(self, key, value):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, self.encode(value)))
+
+    def remove_events(self, ids):
+        ids = list(ids)
+        with self.db:
+            counts = defaultdict(int)
+            for source, kind, day, week, month in self.select_in(
+                    'SELECT source, kind, day, week, month FROM events WHERE id IN ({0})', ids):
+                for key in rollup_keys(source, kind, {'day': day, 'week': week, 'month': month}):
+                    counts[key] -= 1
+            for batch in batches(ids, self.max_params):
+                params = ','.join('?' * len(batch))
+                self.db.execute('DELETE FROM events WHERE id IN ({0})'.format(params), batch)
+                self.db.execute('DELETE FROM search WHERE id IN ({0})'.format(params), batch)
+            self.add_rollups(counts)
+
+    def write_search(self, entries):
+        with self.db:
+            for batch in batches([_id for _id, terms in entries], self.max_params):
+                self.db.execute('DELETE FROM search WHERE id IN ({0})'.format(','.join('?' * len(batch))), batch)
+            self.db.executemany('INSERT INTO search VALUES (?, ?, ?)', [
+                (term, _id, weight) for _id, terms in entries for term, weight in terms.iteritems()])
+
+    def search_ids(self, terms, source=None):
+        frequencies = dict(self.select_in('SELECT term, COUNT(*) FROM search WHERE term IN ({0}) GROUP BY term', terms))
+        if len(frequencies) < len(terms):
+            return []
+        total = sum(self.events_by_source_count().itervalues())
+
+        query = 'SELECT SUM(s.weight * CASE s.term {0} END) AS score, s.id FROM search s'.format(
+            ' '.join('WHEN ? THEN ?' for term in terms))
+        params = [value for term in terms for value in (term, search.idf(total, frequencies[term]))]
+        if source is not None:
+            query += ' JOIN events e ON e.id = s.id AND e.source = ?'
+            params.append(source)
+        query += ' WHERE s.term IN ({0}) GROUP BY s.id HAVING COUNT(*) = ? ORDER BY score DESC'.format(
+            ','.join('?' * len(terms)))
+        return self.db.execute(query, params + terms + [len(terms)])
+
+    def timeline_entry_ids(self, event_ids):
+        return set(entry_id for entry_id, in self.select_in(
+            'SELECT entry_id FROM timeline_children WHERE event_id IN ({0})', event_ids))
+
+    def timeline_entries(self, ids):
+        entries = dict((_id, self.decode(data)) for _id, data in
+                       self.select_in('SELECT id, data FROM timeline WHERE id IN ({0})', list(ids)))
+        return [entries[_id] for _id in ids if _id in entries]
+
+    def timeline_groups(self, source_id, low, high):
+        query = 'SELECT data FROM timeline WHERE source = ? AND is_group = 1 AND timestamp '
+        rows = self.db.execute(query + 'BETWEEN ? AND ?', (source_id, low, high)).fetchall()
+        rows += self.db.execute(query + '> ? ORDER BY timestamp LIMIT 1', (source_id, high)).fetchall()
+        return [self.decode(data) for data, in rows]
+
+    def timeline_page(self, count, position=None):
+        query, params = 'SELECT data FROM timeline', []
+        if position is not None:
+            query += ' WHERE timestamp <= ? AND (timestamp < ? OR id < ?)'
+            params = [position[0], position[0], position[1]]
+        query += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+        return [self.decode(data) for data, in self.db.execute(query, params + [count])]
+
+    def write_timeline(self, entries, deleted):
+        with self.db:
+            for batch in batches([entry['_id'] for entry in deleted], self.max_params):
+                params = ','.join('?' * len(batch))
+                self.db.execute('DELETE FROM timeline WHERE id IN ({0})'.format(params), batch)
+                self.db.execute('DELETE FROM timeline_children WHERE entry_id IN ({0})'.format(params), batch)
+            self.db.executemany('INSERT OR REPLACE INTO timeline VALUES (?, ?, ?, ?, ?)', [
+                (entry['_id'], entry['timestamp'], entry['source'], int(is_group(entry)), self.encode(entry))
+                for entry in entries])
+            self.db.executemany('INSERT OR REPLACE INTO timeline_children VALUES (?, ?)', [
+                (child, entry['_id']) for entry in entries for child in entry['children']])
+
+    def clear_timeline(self):
+        with self.db:
+            self.db.execute('DELETE FROM timeline')
+            self.db.execute('DELETE FROM timeline_children')
+
+    def event_size(self, event):
+        return len(self.codec.encode(event))
+
+    def compact_storage(self):
+        # Freed pages are otherwise only reused, never returned.
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.db.execute('VACUUM')
+
+    def empty(self):
+        sources = self.get_sources()
+        with self.db:
+            for table in ('events', 'rollups', 'timeline', 'timeline_children', 'search'):
+                self.db.execute('DELETE FROM ' + table)
+            self.db.executemany('UPDATE sources SET data = ? WHERE id = ?', [
+                (self.encode(reset_source_state(source_data)), source_id)
+                for source_id, source_data in sources.iteritems()])
+
+
+class CachingStore(object):
+    """Wraps a store, caching the results of its reads (pages of events,
+    slug lookups, source configs, rollups and the timeline) in an LRU cache
+    of `size` results that expire after `ttl` seconds.
+
+    Each cached result is tagged with the data it depends on, so that
+    writes through the wrapper invalidate exactly the results they affect.
+    Other methods are passed through to the wrapped store. Hits and misses
+    are counted per method in self.stats."""
+    def __init__(self, store, size=1024, ttl=60):
+        self.store = store
+        self.cache = LRUCache(size, ttl)
+        self.stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def cached(self, method, args, tags):
+        """Returns the result of a read, from the cache if possible. `tags`
+        may be a function of the result."""
+        key = (method,) + args
+        entry = self.cache.get(key)
+        if entry is None:
+            self.stats[method]['misses'] += 1
+            result = getattr(self.store, method)(*args)
+            if hasattr(result, 'next'):
+                result = list(result)
+            if callable(tags):
+                tags = tags(result)
+            self.cache[key] = (frozenset(tags), result)
+        else:
+            self.stats[method]['hits'] += 1
+            result = entry[1]
+        # Callers may modify what they are given (reprocessing does).
+        return copy.deepcopy(result)
+
+    def invalidate(self, tags):
+        tags = set(tags)
+        self.cache.remove_if(lambda key, entry: not tags.isdisjoint(entry[0]))
+
+    def page_tags(self, source):
+        return ['pages', 'events:' + (source if source is not None else '*')]
+
+    def rollup_tags(self, source=None, kind=None):
+        filter = self.store.histogram_filter(source, kind)
+        return ['rollups', 'rollups:' + (filter or '*')]
+
+    def source_tags(self, source_id, kind):
+        """Tags of the cached results that a change to a source's events affects."""
+        return ['events:*', 'events:' + source_id, 'timeline',
+                'rollups:*', 'rollups:source:' + source_id, 'rollups:kind:' + kind]
+
+    def get_sources(self):
+        return self.cached('get_sources', (), ['sources'])
+
+    def events(self, count=100, before=None, source=None, descending=True):
+        return self.cached('events', (count, before, source, descending), self.page_tags(source))
+
+    def events_page(self, count=100, cursor=None, source=None, after=None, before=None):
+        return self.cached('events_page', (count, cursor, source, after, before), self.page_tags(source))
+
+    def events_by_slug(self, slug):
+        # Also tagged with the ids of the events found, since removals only know ids.
+        return self.cached('events_by_slug', (slug,), lambda events:
+                           ['slug:' + slug] + ['event:' + event['_id'] for event in events])
+
+    def events_by_source_count(self):
+        return self.cached('events_by_source_count', (), self.rollup_tags())
+
+    def histogram(self, period='day', source=None, kind=None):
+        return self.cached('histogram', (period, source, kind), self.rollup_tags(source, kind))
+
+    def timeline(self, count=100, cursor=None):
+        return self.cached('timeline', (count, cursor), ['timeline'])
+
+    def collapsed_events(self, count=100, before=None, cursor=None):
+        return self.cached('collapsed_events', (count, before, cursor), ['timeline'])
+
+    def event_tags(self, events, tags):
+        """Passes events through, adding the ids and slugs of those stored to `tags`."""
+        for event in events:
+            prepare_event(event)
+            tags.add('event:' + event['_id'])
+            if event.get('slug'):
+                tags.add('slug:' + event['slug'])
+            yield event
+
+    def store_events(self, events):
+        tags = set()
+        sources = set()
+
+        def track(events):
+            for event in events:
+                sources.add((event['source'], event.get('kind', '')))
+                yield event
+
+        changed = self.store.store_events(self.event_tags(track(events), tags))
+        if changed:
+            for source_id, kind in sources:
+                tags.update(self.source_tags(source_id, kind))
+            self.invalidate(tags)
+        return changed
+
+    def store_update(self, source, events):
+        tags = set()
+        changed = self.store.store_update(source, self.event_tags(events, tags))
+        if changed or source.removed:
+            tags.update(self.source_tags(source.source_id, source.kind))
+            tags.update('event:' + _id for _id in source.removed)
+        else:
+            tags = set()
+        tags.add('sources')
+        self.invalidate(tags)
+        return changed
+
+    def store_source(self, source):
+        self.store.store_source(source)
+        self.invalidate(['sources'])
+
+    def remove_events(self, ids):
+        ids = list(ids)
+        self.store.remove_events(ids)
+        # The sources of removed events are unknown, so all pages may change.
+        self.invalidate(['pages', 'timeline', 'rollups'] + ['event:' + _id for _id in ids])
+
+    def rebuild_rollups(self):
+        wrong = self.store.rebuild_rollups()
+        self.invalidate(['rollups'])
+        return wrong
+
+    def rebuild_timeline(self):
+        self.store.rebuild_timeline()
+        self.invalidate(['timeline'])
+
+    def compact(self, now=None):
+        result = self.store.compact(now)
+        self.cache.clear()
+        return result
+
+    def empty(self):
+        self.store.empty()
+        self.cache.clear()
+
+
 store_map = {
     'couch': CouchStore,
     'redis': RedisStore,
+    'sqlite': SqliteStore,
 }
@@ -0,0 +1,182 @@
+import gzip
+import json
+import Queue
+import threading
+import zlib
+
+from been.stores import decode_cursor, encode_cursor
+from been.util import batches
+
+
+class StoredSource(object):
+    """Stands in for a source when copying its stored config."""
+    removed = ()
+
+    def __init__(self, source_id, config):
+        self.source_id = source_id
+        self.config = config
+        self.kind = config.get('kind')
+
+
+def read_ahead(pages, depth=4):
+    """Iterates over `pages` on a background thread, keeping up to `depth`
+    pages ready, so that reading overlaps with the caller's writes."""
+    queue = Queue.Queue(depth)
+    done = object()
+
+    def read():
+        try:
+            for page in pages:
+                queue.put(page)
+        except Exception, e:
+            queue.put(e)
+        queue.put(done)
+
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = queue.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def strip_revision(event):
+    event.pop('_rev', None)
+    return event
+
+
+def strip_source(config):
+    """Returns a copy of a stored source config without the fields CouchDB
+    adds to its documents."""
+    return dict((key, value) for key, value in config.iteritems() if key not in ('_id', '_rev', 'type'))
+
+
+def migrate(from_store, to_store, origin=None, restart=False, page_size=None, progress=None):
+    """Copies all sources and events from one store to another, a page at a
+    time. Pages are read ahead while the previous page is written, and a
+    checkpoint is saved in the target store after each page, so that an
+    interrupted migration from the same `origin` resumes where it stopped
+    unless `restart` is set. Calls progress(copied) after each page.
+
+    Returns a dict of {source_id: (from_count, to_count)} for the sources
+    whose event counts differ after copying."""
+    for source_id, source_data in from_store.get_sources().iteritems():
+        to_store.store_source(StoredSource(source_id, strip_source(source_data)))
+
+    checkpoint = to_store.get_state('migrate')
+    cursor, copied = None, 0
+    if checkpoint and checkpoint['origin'] == origin and not restart:
+        cursor, copied = checkpoint['cursor'], checkpoint['copied']
+
+    for page, cursor in read_ahead(from_store.event_pages(page_size=page_size, cursor=cursor)):
+        to_store.store_events(strip_revision(event) for event in page)
+        copied += len(page)
+        to_store.store_state('migrate', {'origin': origin, 'cursor': cursor, 'copied': copied})
+        if progress:
+            progress(copied)
+
+    # Only store_update maintains the timeline.
+    to_store.rebuild_timeline()
+    to_store.store_state('migrate', None)
+
+    from_counts = from_store.events_by_source_count()
+    to_counts = to_store.events_by_source_count()
+    return dict((source_id, (from_counts.get(source_id, 0), to_counts.get(source_id, 0)))
+                for source_id in set(from_counts) | set(to_counts)
+                if from_counts.get(source_id, 0) != to_counts.get(source_id, 0))
+
+
+EXPORT_VERSION = 1
+
+
+def export(store, fileobj, after=None, cursor=None, page_size=1000):
+    """Writes the store's sources and events (newest first) to fileobj as
+    gzipped newline-delimited JSON, one {"type": ...} record per line. With
+    `after` (a timestamp), only events at or after it are written; with
+    `cursor` (returned by a previous export), only events newer than those
+    exported then.
+
+    Returns the number of events written and the cursor to pass to the next
+    incremental export."""
+    skip = None
+    if cursor:
+        skip = decode_cursor(cursor)
+        after = skip[0] if after is None else max(after, skip[0])
+
+    def dump(record):
+        out.write(json.dumps(record, separators=(',', ':'), default=unicode))
+        out.write('\n')
+
+    out = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+    dump({'type': 'header', 'version': EXPORT_VERSION})
+    for source_id, config in sorted(store.get_sources().iteritems()):
+        dump({'type': 'source', '_id': source_id, 'config': strip_source(config)})
+
+    count, newest = 0, cursor
+    for page, page_cursor in read_ahead(store.event_pages(after=after, page_size=page_size)):
+        for event in page:
+            position = (event['timestamp'], event['_id'])
+            if skip and position <= skip:
+                continue
+            if not count:
+                newest = encode_cursor(*position)
+            event.pop('_rev', None)
+            dump({'type': 'event', 'event': event})
+            count += 1
+    out.close()
+    return count, newest
+
+
+def gunzip_lines(fileobj, chunk_size=64 * 1024):
+    """Yields the lines of gzipped data. Unlike GzipFile, this reads pipes,
+    which cannot seek."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+    for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+        lines = (pending + decompressor.decompress(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    pending += decompressor.flush()
+    if pending:
+        yield pending
+
+
+def read_export(fileobj):
+    """Yields the records of an export."""
+    for line in gunzip_lines(fileobj):
+        record = json.loads(line)
+        if record['type'] == 'header' and record['version'] > EXPORT_VERSION:
+            raise ValueError('unsupported export version {0}'.format(record['version']))
+        yield record
+
+
+def import_(store, fileobj, progress=None):
+    """Imports an export into a store. Events are written in batches and
+    keyed by id, so importing the same export twice changes nothing.
+    Calls progress(imported) after each batch. Returns the number of events
+    read and the number that were added or changed."""
+    def events():
+        # Sources come first, so they are all stored before the first batch
+        # of events is written.
+        for record in read_export(fileobj):
+            if record['type'] == 'source':
+                store.store_source(StoredSource(record['_id'], strip_source(record['config'])))
+            elif record['type'] == 'event':
+                yield record['event']
+
+    count, changed = 0, 0
+    for batch in read_ahead(batches(events(), store.batch_size)):
+        changed += store.store_events(batch)
+        count += len(batch)
+        if progress:
+            progress(count)
+
+    if changed:
+        # Only store_update maintains the timeline.
+        store.rebuild_timeline()
+    return count, changed
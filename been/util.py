@@ -0,0 +1,80 @@
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+
+
+_pools = {}
+
+
+def process_pool(processes):
+    """Returns a shared multiprocessing pool with the given number of workers."""
+    if processes not in _pools:
+        _pools[processes] = multiprocessing.Pool(processes)
+    return _pools[processes]
+
+
+def batches(iterable, size):
+    """Yields lists of up to `size` items from an iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered_map(pool, func, iterable, window):
+    """Like pool.imap, but keeps at most `window` calls in flight, so the
+    input is consumed lazily rather than all at once."""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class LRUCache(object):
+    """A thread-safe mapping holding at most `size` items, evicting the least
+    recently used item when full. If `ttl` is set, items expire that many
+    seconds after they were set."""
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            self.items[key] = expires, value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl if self.ttl else None), value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+    def remove_if(self, predicate):
+        """Removes the items for which predicate(key, value) is true."""
+        with self.lock:
+            for key, (expires, value) in self.items.items():
+                if predicate(key, value):
+                    del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
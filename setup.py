@@ -21,6 +21,8 @@ setup(
     ],
     extras_require={
         "twitter": ["python-twitter"],
+        "msgpack": ["msgpack"],
+        "zstd": ["zstandard"],
     },
     entry_points={
         "console_scripts": [